@@ -0,0 +1,95 @@
+"""\
+Compares Field conversion through the compiled per-field converters against the
+issubclass/isinstance dispatch chain that Field used before (reproduced below),
+on nested list/dict fields.
+
+	python benchmarks/bench_fields.py
+"""
+import os
+import sys
+import timeit
+import inspect
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lingo import lingo
+
+class SampleEmbeddedModel(lingo.Model):
+	class __Prototype__:
+		__Embedded__=True
+		strField=lingo.Field(unicode, default=u"")
+		intField=lingo.Field(int, default=0)
+
+def dispatch_scalar_to_python(ftype, value):
+	if inspect.isclass(ftype) and isinstance(value, ftype):
+		return value
+	elif isinstance(ftype, lingo.Field):
+		return dispatch_to_python(ftype, value)
+	elif issubclass(ftype, lingo.Model):
+		return ftype(**value)
+	elif issubclass(ftype, datetime):
+		return lingo._datetime_to_python(value)
+	else:
+		return ftype(value)
+
+def dispatch_to_python(field, value):
+	if field.ftype is not None and value is not None:
+		if issubclass(field.ftype, list):
+			value = value if isinstance(value, list) else [value]
+			value = [dispatch_scalar_to_python(field.fsubtype, v) for v in value]
+		elif issubclass(field.ftype, dict):
+			value = value if isinstance(value, dict) else {str(value): value}
+			value = {k:dispatch_scalar_to_python(field.fsubtype, v) for k,v in value.items()}
+		else:
+			value = dispatch_scalar_to_python(field.ftype, value)
+	return value
+
+def dispatch_scalar_to_json(ftype, value):
+	if isinstance(ftype, lingo.Field):
+		return dispatch_to_json(ftype, value)
+	elif issubclass(ftype, lingo.Model):
+		if ftype._get_schema().embedded:
+			return value._to_json()
+		else:
+			return str(value._id)
+	elif issubclass(ftype, datetime):
+		return lingo._datetime_to_json(value)
+	else:
+		return value
+
+def dispatch_to_json(field, value):
+	if field.ftype is not None and value is not None:
+		if issubclass(field.ftype, list):
+			value = [dispatch_scalar_to_json(field.fsubtype, v) for v in value]
+		elif issubclass(field.ftype, dict):
+			value = {k:dispatch_scalar_to_json(field.fsubtype, v) for k,v in value.items()}
+		else:
+			value = dispatch_scalar_to_json(field.ftype, value)
+	return value
+
+CASES = [
+	('list of int', lingo.Field(list, int), range(100)),
+	('list of datetime', lingo.Field(list, datetime), ['2015-01-04T05:47:45.578293+00:00'] * 10),
+	('dict of list of int', lingo.Field(dict, lingo.Field(list, int)), {str(k): range(10) for k in range(10)}),
+	('dict of list of embedded', lingo.Field(dict, lingo.Field(list, SampleEmbeddedModel)),
+		{str(k): [dict(strField=u'foo', intField=v) for v in range(5)] for k in range(4)}),
+]
+
+def bench(func, number):
+	return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def main(number=2000):
+	print "%-28s %-8s %12s %12s %8s" % ('field', 'op', 'dispatch us', 'compiled us', 'speedup')
+	for name, field, value in CASES:
+		python_value = field._to_python(value)
+		for op, old, new in [
+			('python', lambda: dispatch_to_python(field, value), lambda: field._to_python(value)),
+			('json', lambda: dispatch_to_json(field, python_value), lambda: field._to_json(python_value)),
+		]:
+			t_old = bench(old, number)
+			t_new = bench(new, number)
+			print "%-28s %-8s %12.2f %12.2f %7.2fx" % (name, op, t_old * 1e6, t_new * 1e6, t_old / t_new)
+
+if __name__ == '__main__':
+	main()
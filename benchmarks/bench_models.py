@@ -0,0 +1,105 @@
+"""\
+Benchmarks for the model/field layer, modeled on the SampleModel and
+SampleNestedModel of the tests.  None of them need a database; run them with
+benchmarks/run.py.
+"""
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytz
+
+from lingo import lingo
+
+class SampleEmbeddedModel(lingo.Model):
+	class __Prototype__:
+		__Embedded__=True
+		strField=lingo.Field(unicode, default=u"")
+		intField=lingo.Field(int, default=0)
+
+class SampleScalarModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		strField=lingo.Field(unicode, default=u"")
+		intField=lingo.Field(int, default=0)
+		floatField=lingo.Field(float, default=0.0)
+		boolField=lingo.Field(bool, default=False)
+
+class SampleDatetimeModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		created=lingo.Field(datetime)
+		updated=lingo.Field(datetime)
+		published=lingo.Field(datetime)
+		expires=lingo.Field(datetime)
+
+class SampleModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		strField=lingo.Field(unicode, default=u"")
+		embedField=lingo.Field(SampleEmbeddedModel, default=SampleEmbeddedModel)
+
+class SampleListModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		listField=lingo.Field(list, SampleEmbeddedModel, default=list)
+
+class SampleNestedModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		nestedField=lingo.Field(dict, lingo.Field(list, SampleEmbeddedModel), default=dict)
+
+_NOW = datetime(2015, 1, 4, 5, 47, 45, 578293).replace(tzinfo = pytz.utc)
+
+DOCUMENTS = {
+	'scalar': (SampleScalarModel, dict(_id=u'a', strField=u'foo', intField=3, floatField=1.5, boolField=True)),
+	'datetime': (SampleDatetimeModel, dict(_id=u'a', created=_NOW, updated=_NOW, published=_NOW, expires=_NOW)),
+	'embedded': (SampleModel, dict(_id=u'a', strField=u'foo', embedField=dict(strField=u'bar', intField=3))),
+	'list_of_embedded': (SampleListModel, dict(_id=u'a', listField=[dict(strField=u'bar', intField=v) for v in range(10)])),
+	'dict_of_list': (SampleNestedModel, dict(_id=u'a', nestedField={k: [dict(strField=k, intField=v) for v in range(3)] for k in 'abcd'})),
+}
+
+def _read_all(instance):
+	for k in instance._fields():
+		getattr(instance, k)
+
+def _make(model, data):
+	json = model(**data)._to_json()
+	instance = model(**data)
+	loaded = model._load(json)
+	_read_all(loaded)
+	field = sorted(k for k in model._fields() if k != '_id')[0]
+	value = getattr(instance, field)
+
+	return [
+		('construct', lambda: model(**data)),
+		('load', lambda: model._load(json)),
+		('load_read', lambda: _read_all(model._load(json))),
+		('getattr', lambda: getattr(loaded, field)),
+		('setattr', lambda: setattr(instance, field, value)),
+		('to_json', lambda: instance._to_json()),
+		('to_json_loaded', lambda: model._load(json)._to_json()),
+		('round_trip', lambda: _read_all(model._load(model(**data)._to_json()))),
+	]
+
+def _validate_cases():
+	f_int = lingo.Field(int, default=0)
+	f_datetime = lingo.Field(datetime)
+	f_nested = lingo.Field(dict, lingo.Field(list, SampleEmbeddedModel))
+	nested = DOCUMENTS['dict_of_list'][1]['nestedField']
+	return [
+		('field.validate.int', lambda: f_int.validate("12")),
+		('field.validate.datetime', lambda: f_datetime.validate('2015-01-04T05:47:45.578293+00:00')),
+		('field.validate.dict_of_list', lambda: f_nested.validate(nested)),
+	]
+
+def benchmarks():
+	"""A list of (name, callable) pairs, in a stable order"""
+	out = []
+	for name in sorted(DOCUMENTS):
+		model, data = DOCUMENTS[name]
+		out.extend(('%s.%s' % (name, op), func) for op, func in _make(model, data))
+	out.extend(_validate_cases())
+	return out
@@ -0,0 +1,93 @@
+"""\
+Runs the model/field benchmarks and reports operations per second and the
+number of garbage-collected objects each operation leaves alive (which is
+what a result such as a model instance costs in memory).
+
+	python benchmarks/run.py                          # run everything
+	python benchmarks/run.py -k datetime              # only names containing "datetime"
+	python benchmarks/run.py --save baseline.json     # record a baseline
+	python benchmarks/run.py --compare baseline.json  # exit 1 on regressions
+
+A benchmark regresses when its ops/sec drops by more than --tolerance
+(a fraction, 0.15 by default) or when it retains more objects per operation.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_models
+
+def measure_speed(func, min_time = 0.1, repeat = 7):
+	# Process CPU time, so other load on the machine skews the results less
+	timer = timeit.Timer(func, timer = time.clock)
+	number = 1
+	while timer.timeit(number) < min_time:
+		number *= 2
+	return number / min(timer.repeat(repeat, number))
+
+def measure_objects(func, number = 200):
+	gc.collect()
+	gc.disable()
+	try:
+		before = len(gc.get_objects())
+		results = [func() for _ in xrange(number)]
+		after = len(gc.get_objects())
+	finally:
+		gc.enable()
+	# The results list itself is one tracked object
+	return max(0.0, (after - before - 1) / float(number))
+
+def run(names = None):
+	out = {}
+	for name, func in bench_models.benchmarks():
+		if names and not any(n in name for n in names):
+			continue
+		out[name] = {'ops': measure_speed(func), 'objects': measure_objects(func)}
+		sys.stderr.write("%-40s %12.0f ops/s %8.1f objs/op\n" % (name, out[name]['ops'], out[name]['objects']))
+	return out
+
+def compare(results, baseline, tolerance):
+	regressions = []
+	print "%-40s %12s %12s %8s %10s" % ('benchmark', 'baseline', 'ops/s', 'change', 'objs/op')
+	for name in sorted(results):
+		current = results[name]
+		if name not in baseline:
+			print "%-40s %12s %12.0f %8s %10.1f" % (name, '-', current['ops'], 'new', current['objects'])
+			continue
+		base = baseline[name]
+		change = current['ops'] / base['ops'] - 1
+		flag = ''
+		if change < -tolerance or current['objects'] > base['objects'] + 0.5:
+			regressions.append(name)
+			flag = ' REGRESSION'
+		print "%-40s %12.0f %12.0f %+7.1f%% %4.1f->%-4.1f%s" % (name, base['ops'], current['ops'], change * 100, base['objects'], current['objects'], flag)
+	return regressions
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = "lingo model/field benchmarks")
+	parser.add_argument('-k', dest = 'names', action = 'append', help = "only run benchmarks whose name contains this")
+	parser.add_argument('--save', help = "write the results to this JSON file")
+	parser.add_argument('--compare', help = "compare against a JSON file written by --save")
+	parser.add_argument('--tolerance', type = float, default = 0.15, help = "allowed drop in ops/sec before a benchmark counts as regressed")
+	args = parser.parse_args(argv)
+
+	results = run(args.names)
+	if args.save:
+		with open(args.save, 'w') as fp:
+			json.dump(results, fp, indent = 1, sort_keys = True)
+	if args.compare:
+		with open(args.compare) as fp:
+			regressions = compare(results, json.load(fp), args.tolerance)
+		if regressions:
+			sys.stderr.write("%d regression(s): %s\n" % (len(regressions), ', '.join(regressions)))
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,19 +1,160 @@
+import os
 import re
 import httplib
 import urllib
 import json
 from urlparse import urlparse
 import types
+import inspect
 import threading
+import socket
+import copy
+from multiprocessing.pool import ThreadPool
+import time
+import logging
+import hashlib
+import zlib
 from datetime import datetime
 import base64
+from collections import OrderedDict, namedtuple, deque
 
 import pymongo
 import bson
 
 from errors import *
+from instrumentation import Operation
+from pool import ConnectionPool
 import lingo
 
+log = logging.getLogger(__name__)
+
+# The outcome of writing one instance in a bulk operation; error and reason are
+# set, and id/rev left as they were, if the database rejected the document
+BulkResult = namedtuple('BulkResult', 'instance id rev error reason')
+
+# One entry of the CouchDB changes feed; instance is the hydrated model when the feed
+# includes documents of a known type, and None otherwise (and for deletions)
+Change = namedtuple('Change', 'seq id rev deleted instance')
+
+# A row of a view queried for its rows rather than for models; id is None for the
+# rows of a reduce
+ViewRow = namedtuple('ViewRow', 'key value id')
+
+def _all_subclasses(cls):
+    out = []
+    for subclass in cls.__subclasses__():
+        out.append(subclass)
+        out.extend(_all_subclasses(subclass))
+    return out
+
+def time_ordered_id():
+    """\
+    A 32 hex digit document id made of the current time in microseconds followed by
+    random bits, like CouchDB's utc_random algorithm: ids of documents created one
+    after another sort together, which keeps inserts local in the database's B-trees
+    """
+    return '%014x%s' % (int(time.time() * 1000000), os.urandom(9).encode('hex'))
+
+class UUIDPool(object):
+    """\
+    Document ids from the server's _uuids, fetched size at a time and handed out
+    one per call; safe to share between threads
+    """
+    def __init__(self, db, size = 100):
+        self.db = db
+        self.size = size
+        self.ids = deque()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if not self.ids:
+                self.ids.extend(self.db._get_uuids(self.size))
+            return self.ids.popleft()
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default = None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last = False)
+
+    def pop(self, key, default = None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+class Session(object):
+    """\
+    A unit of work on a database: while active, every document loaded or saved
+    through the database is kept in an identity map bounded to maxsize entries,
+    so the same document is only fetched once and is always the same instance.
+    """
+    def __init__(self, db, maxsize = 1000):
+        self.db = db
+        self.identity_map = LRUCache(maxsize)
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = self.db._get_session()
+        self.db._local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db._local.session = self._previous
+        self._previous = None
+
+    @classmethod
+    def _key(self, model, _id):
+        return (model.get_type_name(), unicode(_id))
+
+    def get(self, model, _id):
+        return self.identity_map.get(self._key(model, _id))
+
+    def merge(self, instance):
+        """Add a freshly loaded instance, or return the one already in the session"""
+        if instance.is_partial():
+            return instance
+        key = self._key(instance.__class__, instance._id)
+        existing = self.identity_map.get(key)
+        if existing is not None:
+            return existing
+        self.identity_map.put(key, instance)
+        return instance
+
+    def add(self, instance):
+        if instance.is_partial():
+            return
+        self.identity_map.put(self._key(instance.__class__, instance._id), instance)
+
+    def remove(self, instance):
+        self.identity_map.pop(self._key(instance.__class__, instance._id))
+
+    def clear(self):
+        self.identity_map.clear()
+
+    def __len__(self):
+        return len(self.identity_map)
+
 class Database(object):
     instances = {}
 
@@ -37,6 +178,9 @@ class Database(object):
             raise DatabaseError("A '%s' instance with the name '%s' already exists" % (cls, name_))
 
         self.instances[cls][name_] = self
+        self._local = threading.local()
+        self.hooks = []
+        self.slow_threshold = None  # Seconds; slower operations are logged as warnings
 
     @classmethod
     def get_instance(self, cls, name = None):
@@ -56,6 +200,80 @@ class Database(object):
     def preprocess(self, model_instance, data):
         return True
 
+    def add_hook(self, hook):
+        """\
+        Register a callable to receive an instrumentation.Operation for every
+        operation this database performs, e.g. an instrumentation.Stats
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _record(self, operation, target, model, duration, retries = 0, error = None):
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            log.warning("Slow %s operation: %s %s (%s) took %.3fs" % (self.__class__.__name__, operation, target, model.get_type_name() if model else '-', duration))
+        if self.hooks:
+            event = Operation(self.__class__.__name__, operation, target, model.get_type_name() if model else None, duration, retries, error)
+            for hook in self.hooks:
+                try:
+                    hook(event)
+                except Exception as e:
+                    log.error("Instrumentation hook failed: %s: %s" % (e.__class__.__name__, str(e)))
+
+    def session(self, maxsize = 1000):
+        """\
+        Start a unit of work for the current thread; use as a context manager:
+            with db.session():
+                ...
+        """
+        return Session(self, maxsize)
+
+    def _get_session(self):
+        return getattr(self._local, 'session', None)
+
+    def _merge(self, instance):
+        session = self._get_session()
+        if session is None or instance._id is None:
+            return instance
+        return session.merge(instance)
+
+    def _get_reference(self, model, _id):
+        """Load the document a reference field points to, when the field is read"""
+        return self.get(model, _id)
+
+    def _prefetch(self, instances, fields):
+        """\
+        Resolve the named reference fields of every instance, loading the referenced
+        documents with one query per referenced model instead of one per instance.
+        """
+        for name in fields:
+            pending = {}
+            for instance in instances:
+                field = instance._fields().get(name)
+                if field is None or not (inspect.isclass(field.ftype) and issubclass(field.ftype, lingo.Model)) or field.ftype._clsattr('__Embedded__'):
+                    raise ModelError("%s.%s is not a reference to another model" % (instance.__class__.__name__, name))
+                _id = instance._unresolved_reference(name)
+                if _id is not None:
+                    pending.setdefault(field.ftype, []).append((instance, _id))
+            for model, refs in pending.items():
+                db = model.database().db_instance
+                session = db._get_session()
+                loaded = {}
+                missing = set()
+                for _, _id in refs:
+                    instance = session.get(model, _id) if session else None
+                    if instance is not None:
+                        loaded[_id] = instance
+                    else:
+                        missing.add(_id)
+                if missing:
+                    loaded.update(db._get_by_ids(model, list(missing)))
+                for instance, _id in refs:
+                    if _id in loaded:
+                        instance._resolve_reference(name, loaded[_id])
+
     def attach(self, model_instance, name, file_obj = None, data = None, content_type = None):
         raise DatabaseError("Attachments are not supported by " + self.__class__.__name__)
 
@@ -84,9 +302,63 @@ class DatabasePartial(object):
             return attr
 
 class MongoDBCustomCursor(object):
-    def __init__(self, wrapped, cls):
+    def __init__(self, wrapped, cls, db, spec=None, kwargs=None, fields=None):
         self.__dict__['wrapped']=wrapped
         self.__dict__['cls']=cls
+        self.__dict__['db']=db
+        self.__dict__['spec']=spec
+        self.__dict__['kwargs']=kwargs or {}
+        self.__dict__['fields']=fields
+        self.__dict__['prefetch_fields']=[]
+        self.__dict__['prefetch_batch']=100
+
+    def prefetch(self, *fields):
+        self.__dict__['prefetch_fields'].extend(fields)
+        return self
+
+    def only(self, *fields):
+        """Load only the named fields (and _id) into partial models"""
+        return self._project(list(fields))
+
+    def exclude(self, *fields):
+        """Load every field except those named into partial models"""
+        return self._project({k: False for k in fields})
+
+    def _project(self, projection):
+        kwargs=dict(self.__dict__['kwargs'], fields=projection)
+        return self.__dict__['db'].find(self.__dict__['cls'], self.__dict__['spec'], **kwargs).prefetch(*self.__dict__['prefetch_fields'])
+
+    def _load(self, data):
+        return self.__dict__['db']._merge(self.__dict__['cls']._load(data, self.__dict__['fields']))
+
+    def count(self, with_limit_and_skip=False):
+        """The number of matching documents, counted by the server without loading any"""
+        db=self.__dict__['db']
+        cls=self.__dict__['cls']
+        collection=db._getCollection(cls)
+        started=time.time()
+        if hasattr(collection, 'count_documents'):
+            # pymongo >= 3.7, where Cursor.count is deprecated
+            options={}
+            if with_limit_and_skip:
+                for k in ('limit', 'skip'):
+                    if self.__dict__['kwargs'].get(k):
+                        options[k]=self.__dict__['kwargs'][k]
+            out=collection.count_documents(self.__dict__['spec'] or {}, **options)
+        else:
+            out=self.__dict__['wrapped'].count(with_limit_and_skip)
+        db._record('count', collection.name, cls, time.time() - started)
+        return out
+
+    def limit(self, limit):
+        self.__dict__['wrapped'].limit(limit)
+        self.__dict__['kwargs']=dict(self.__dict__['kwargs'], limit=limit)
+        return self
+
+    def skip(self, skip):
+        self.__dict__['wrapped'].skip(skip)
+        self.__dict__['kwargs']=dict(self.__dict__['kwargs'], skip=skip)
+        return self
 
     def __getattr__(self, k):
         return getattr(self.__dict__['wrapped'], k)
@@ -97,7 +369,42 @@ class MongoDBCustomCursor(object):
     def __getitem__(self, i):
         cls=self.__dict__['cls']
         data=self.__dict__['wrapped'][i]
-        return cls(**data)
+        if isinstance(i, slice):
+            return MongoDBCustomCursor(data, cls, self.__dict__['db'], self.__dict__['spec'], self.__dict__['kwargs'], self.__dict__['fields']).prefetch(*self.__dict__['prefetch_fields'])
+        instance=self._load(data)
+        self.__dict__['db']._prefetch([instance], self.__dict__['prefetch_fields'])
+        return instance
+
+    def __iter__(self):
+        db=self.__dict__['db']
+        cls=self.__dict__['cls']
+        fields=self.__dict__['prefetch_fields']
+        wrapped=iter(self.__dict__['wrapped'])
+        t_fetch=0.0
+        t_hydrate=0.0
+        batch=[]
+        while True:
+            started=time.time()
+            try:
+                data=next(wrapped)
+            except StopIteration:
+                break
+            finally:
+                t_fetch+=time.time() - started
+            started=time.time()
+            batch.append(self._load(data))
+            t_hydrate+=time.time() - started
+            if len(batch) >= self.__dict__['prefetch_batch']:
+                db._prefetch(batch, fields)
+                for instance in batch:
+                    yield instance
+                batch=[]
+        db._prefetch(batch, fields)
+        collection=db._getCollection(cls).name
+        db._record('find', collection, cls, t_fetch)
+        db._record('hydrate', collection, cls, t_hydrate)
+        for instance in batch:
+            yield instance
 
 class MongoDB(Database):
     def __init__(self, server, dbname, name = None):
@@ -111,34 +418,136 @@ class MongoDB(Database):
 
     def find(self, model, spec, **kwargs):
         csr=self._getCollection(model).find(spec, **kwargs)
-        return MongoDBCustomCursor(csr, model)
+        return MongoDBCustomCursor(csr, model, self, spec, kwargs, self._projected_fields(model, kwargs.get('fields')))
+
+    @classmethod
+    def _projected_fields(self, model, projection):
+        if projection is None:
+            return None
+        if not isinstance(projection, dict):
+            projection = {k: True for k in projection}
+        if any('.' in k for k in projection):
+            # Saving a partially loaded subdocument would overwrite the rest of it
+            raise ModelError("Projections into subdocuments are not supported")
+        only = [k for k, v in projection.items() if v]
+        return model._field_subset(only or None, [k for k, v in projection.items() if not v])
+
+    def _get_by_ids(self, model, ids):
+        object_ids = {_id if isinstance(_id, bson.ObjectId) else bson.ObjectId(_id): _id for _id in ids}
+        collection = self._getCollection(model)
+        started = time.time()
+        docs = list(collection.find({"_id": {"$in": object_ids.keys()}}))
+        self._record('find', collection.name, model, time.time() - started)
+        return {object_ids[data["_id"]]: self._merge(model._load(data)) for data in docs}
 
     def one(self, model, *args, **kwargs):
+        started=time.time()
         csr=self.find(model, *args, **kwargs)
-        if csr.count()!=1:
-            raise ValidationError("Invalid result count for one(): expected exactly one, got %d"%(csr.count(),))
-        return csr[0]
+        # Two documents are enough to tell that there is more than one, in a single round trip
+        csr.limit(2)
+        out=list(csr)
+        if len(out)!=1:
+            raise ValidationError("Invalid result count for one(): expected exactly one, got %s"%(len(out) and "more" or 0,))
+        self._record('one', self._getCollection(model).name, model, time.time() - started)
+        return out[0]
 
     def get(self, model, idstr):
         if not isinstance(idstr, bson.ObjectId):
             idstr=bson.ObjectId(idstr)
+        session = self._get_session()
+        if session is not None:
+            instance = session.get(model, idstr)
+            if instance is not None:
+                return instance
         return self.one(model, {"_id": idstr})
 
     def save(self, model_instance, **kwargs):
         if model_instance.__class__._clsattr("__Embedded__"):
             raise ModelError("Model %s is embedded and cannot be saved"%(model_instance.__class__.__name__,))
+        stored = model_instance.__raw__ is not None and model_instance._id
+        if stored and not model_instance.is_dirty():
+            return model_instance._id
         if not model_instance.touch():
             raise ModelError("touch() failed")
-        if model_instance._id:
-            self._getCollection(model_instance.__class__).update({"_id": model_instance._id}, model_instance._asdict(skip=["_id"]), upsert=True, safe=True, multi=False, **kwargs)
+        collection = self._getCollection(model_instance.__class__)
+        started = time.time()
+        if stored:
+            # Only send what changed since the instance was loaded or last saved
+            fields = model_instance.__class__._fields()
+            changed = model_instance.changed_fields() - set(['_id'])
+            data = model_instance._asdict(skip=[k for k in fields if k not in changed])
+            update = {}
+            for k, v in data.items():
+                if v is None and fields[k].default is None:
+                    update.setdefault('$unset', {})[k] = 1
+                else:
+                    update.setdefault('$set', {})[k] = v
+            if update:
+                collection.update({"_id": model_instance._id}, update, safe=True, multi=False, **kwargs)
+        elif model_instance._id:
+            data = model_instance._asdict(skip=["_id"])
+            collection.update({"_id": model_instance._id}, data, upsert=True, safe=True, multi=False, **kwargs)
         else:
-            model_instance._id=self._getCollection(model_instance.__class__).insert(model_instance._asdict(skip=["_id"]), safe=True, **kwargs)
+            data = model_instance._asdict(skip=["_id"])
+            model_instance._id=collection.insert(data, safe=True, **kwargs)
+        self._record('save', collection.name, model_instance.__class__, time.time() - started)
+        data['_id'] = model_instance._id
+        model_instance._mark_clean(data)
+        if self._get_session() is not None:
+            self._get_session().add(model_instance)
         return model_instance._id
 
+_VIEW_ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+_VIEW_ROWS_SKIP = re.compile(r'[\s,]*')
+_json_decoder = json.JSONDecoder()
+
+def _iter_view_rows(fp, chunk_size = 65536):
+    """\
+    Yields the rows of a view response ({"total_rows": ..., "rows": [{...}, ...]}) read
+    from the file-like fp, decoding each as soon as all of it has arrived
+    """
+    buf = ''
+    pos = None
+    eof = False
+    while True:
+        if pos is None:
+            match = _VIEW_ROWS_START.search(buf)
+            if match:
+                pos = match.end()
+                continue
+        else:
+            pos = _VIEW_ROWS_SKIP.match(buf, pos).end()
+            if buf[pos:pos + 1] == ']':
+                return
+            if pos < len(buf):
+                try:
+                    row, end = _json_decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # The row is incomplete, read more of it
+                    pass
+                else:
+                    pos = end
+                    yield row
+                    continue
+            # Drop what has been decoded before reading more
+            buf = buf[pos:]
+            pos = 0
+        if eof:
+            raise DatabaseError("Truncated view response")
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
 class CouchDBViewResult(object):
-    def __init__(self, db, model, view, keys = None, limit = None, page = 0, use_startkey = False):
-        if use_startkey:
-            raise NotImplementedError("Only pagination by limit/offset is supported")
+    """\
+    The rows of a view, fetched lazily.  By default pages are addressed by number
+    and fetched with limit/skip; with use_startkey, each page starts at the key and
+    document id of the row following the previous one, so that deep pages are as
+    cheap as the first: walk them with next_page(), or resume from a page token.
+    """
+    def __init__(self, db, model, view, keys = None, limit = None, page = 0, use_startkey = False, startkey = None, endkey = None, descending = False):
+        if keys is not None and (use_startkey or startkey is not None or endkey is not None):
+            raise DatabaseError("Keys cannot be combined with key ranges or key-based pagination")
 
         self.db = db
         self.model = model
@@ -146,48 +555,332 @@ class CouchDBViewResult(object):
         self.keys = keys
         self.limitnum = limit
         self.pagenum = page
+        self.use_startkey = use_startkey
+        self.startkey = startkey
+        self.endkey = endkey
+        self.descending = descending
 
-        self._total = None
+        self._count = None
         self._data = None
+        self._prefetch_fields = []
+        self._fields = None
+        self._start = None  # (key, docid) of the first row of the page, with use_startkey
+        self._next = None  # (key, docid) of the first row of the next page, with use_startkey
+        self._rows = False
+        self._options = {}
+
+    def prefetch(self, *fields):
+        """Resolve the named reference fields of every fetched row in bulk"""
+        self._prefetch_fields.extend(fields)
+        self._data = None
+        return self
+
+    def only(self, *fields):
+        """\
+        Build partial models holding only the named fields (and _id) from the values
+        emitted by the view, instead of fetching whole documents.  The view must emit
+        an object containing those fields.
+        """
+        self._fields = self.model._field_subset(only = fields)
+        self._data = None
+        return self
+
+    def exclude(self, *fields):
+        """Like only(), for views that emit every field except those named"""
+        self._fields = self.model._field_subset(exclude = fields)
+        self._data = None
+        return self
+
+    def rows(self):
+        """Return the rows of the view as ViewRow, without fetching documents"""
+        self._rows = True
+        self._data = None
+        return self
+
+    def _option(self, name, value):
+        if value is None:
+            self._options.pop(name, None)
+        else:
+            self._options[name] = value
+        self._data = None
+        self._count = None
+        return self
+
+    def reduce(self, enabled = True):
+        """\
+        Run the reduce function of the view; the result is then its rows (see rows()).
+        Without it, reduce views are queried for their map rows.
+        """
+        if enabled:
+            self._rows = True
+        return self._option('reduce', 'true' if enabled else 'false')
+
+    def group(self, enabled = True):
+        """Reduce by distinct key, rather than to a single row"""
+        self.reduce()
+        return self._option('group', 'true' if enabled else None)
+
+    def group_level(self, level):
+        """Reduce by the first level items of array keys"""
+        self.reduce()
+        return self._option('group_level', level)
+
+    def stale(self, mode = 'ok'):
+        """\
+        Read the index as it is, without waiting for it to catch up with the latest
+        changes: 'ok', or 'update_after' to have it updated after answering; None to
+        read an up to date index again
+        """
+        if mode not in ('ok', 'update_after', None):
+            raise DatabaseError("Invalid stale mode: %s" % (mode,))
+        return self._option('stale', mode)
+
+    def inclusive_end(self, inclusive = True):
+        """Whether the rows with the endkey are included (they are by default)"""
+        return self._option('inclusive_end', None if inclusive else 'false')
+
+    def _reduce_function(self):
+        return (self.model._clsattr('__Views__') or {}).get(self.view, {}).get('reduce')
 
     def page(self, pagenum):
+        if self.use_startkey:
+            if pagenum != 0:
+                raise DatabaseError("Pages cannot be addressed by number with use_startkey, use next_page() or page_token()")
+            self._start = None
         self.pagenum = pagenum
         self._data = None
         return self
 
+    def range(self, startkey = None, endkey = None, descending = False):
+        if self.keys is not None:
+            raise DatabaseError("Keys cannot be combined with key ranges")
+        self.startkey = startkey
+        self.endkey = endkey
+        self.descending = descending
+        self._start = None
+        self._data = None
+        self._count = None
+        return self
+
+    @property
+    def next_page_token(self):
+        """An opaque token for the page after this one (see page_token()), or None if this is the last page"""
+        self._get_data()
+        if self._next is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(self._next))
+
+    def page_token(self, token):
+        """Move to the page identified by a token from next_page_token"""
+        if not self.use_startkey:
+            raise DatabaseError("Page tokens require use_startkey")
+        try:
+            key, docid = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise DatabaseError("Invalid page token")
+        self._start = (key, docid)
+        self._data = None
+        return self
+
+    def next_page(self):
+        """Move to the next page; returns None, leaving the current page alone, if this is the last one"""
+        if not self.use_startkey:
+            if self.limitnum is None or (self.pagenum + 1) >= self.pages():
+                return None
+            return self.page(self.pagenum + 1)
+        self._get_data()
+        if self._next is None:
+            return None
+        self._start = self._next
+        self._data = None
+        return self
+
     def limit(self, limit):
         self.limitnum = limit
         self._data = None
         return self
 
     def pages(self):
-        if self._total is None:
-            self.fetch()
+        # After a fetch of the whole view, its total_rows is already known
+        total = self.count()
         if self.limitnum is None:
-            return 1 if self._total else 0
-        return int(self._total / self.limitnum) + (1 if self._total % float(self.limitnum) > 0 else 0)
+            return 1 if total else 0
+        return int(total / self.limitnum) + (1 if total % float(self.limitnum) > 0 else 0)
+
+    def count(self):
+        """\
+        The number of rows of the view, within its keys or key range, counted without
+        fetching any document: with the view's reduce if it is _count, from total_rows
+        for the whole view, or else from the rows alone
+        """
+        if self._count is None:
+            if self._options.get('reduce') == 'true':
+                # The number of rows of the reduce
+                query = self._query()
+                query.pop('limit', None)
+                query.pop('skip', None)
+                self._count = len(self._view_request(query)['rows'])
+                return self._count
+
+            query = {k: v for k, v in self._options.items() if k in ('stale', 'inclusive_end')}
+            if self.startkey is not None:
+                query['startkey'] = json.dumps(self.startkey)
+            if self.endkey is not None:
+                query['endkey'] = json.dumps(self.endkey)
+            if self.descending:
+                query['descending'] = 'true'
+            reduce = self._reduce_function()
+            if reduce == '_count':
+                query['reduce'] = 'true'
+                if self.keys is not None:
+                    # Reducing over keys needs a row per key
+                    query['group'] = 'true'
+                self._count = sum(row['value'] for row in self._view_request(query)['rows'])
+            else:
+                query['include_docs'] = 'false'
+                if reduce:
+                    query['reduce'] = 'false'
+                if self._whole_view():
+                    query['limit'] = 0
+                    self._count = self._view_request(query)['total_rows']
+                else:
+                    self._count = len(self._view_request(query)['rows'])
+        return self._count
+
+    def _whole_view(self):
+        """Whether the map rows of the whole view are queried, so that total_rows is their count"""
+        return self._options.get('reduce') != 'true' and self.keys is None and self.startkey is None and self.endkey is None
+
+    def _url(self):
+        return '/_design/' + self.model.get_type_name() + '/_view/' + self.view
+
+    def _query(self):
+        query = {'include_docs': 'true' if self._fields is None and not self._rows else 'false'}
+        query.update(self._options)
+        if query.get('reduce') == 'true':
+            if self.use_startkey:
+                raise DatabaseError("The rows of a reduce cannot be paginated by key")
+        elif self._reduce_function():
+            # Documents and emitted values come from the map rows
+            query['reduce'] = 'false'
+        startkey = self.startkey
+        if self.use_startkey and self._start is not None:
+            startkey = self._start[0]
+            query['startkey_docid'] = self._start[1]
+        if startkey is not None:
+            query['startkey'] = json.dumps(startkey)
+        if self.endkey is not None:
+            query['endkey'] = json.dumps(self.endkey)
+        if self.descending:
+            query['descending'] = 'true'
+        if self.limitnum is not None:
+            if self.use_startkey:
+                # One extra row tells where the next page starts
+                query['limit'] = self.limitnum + 1
+            else:
+                query.update({
+                    'limit': self.limitnum,
+                    'skip': self.pagenum * self.limitnum
+                })
+        return query
 
-    def fetch(self):
-        method = 'GET'
-        body = None
-        headers = {}
+    def _view_body(self):
         if self.keys:
             body = json.dumps({'keys': self.keys if isinstance(self.keys, list) else [self.keys]})
-            method = 'POST'
-            headers = {'Content-type': 'application/json'}
-        query = {'include_docs': 'true'}
-        if self.limitnum is not None:
-            query.update({
-                'limit': self.limitnum,
-                'skip': self.pagenum * self.limitnum
-            })
-        res = self.db._request_db(method, '/_design/' + self.model.get_type_name() + '/_view/' + self.view, query, body, headers).parsed_body
+            return 'POST', body, {'Content-type': 'application/json'}
+        return 'GET', None, {}
+
+    def _view_request(self, query):
+        method, body, headers = self._view_body()
+        return self.db._request_db(method, self._url(), query, body, headers, model = self.model, cache = True, retry_safe = True).parsed_body
+
+    def fetch(self):
+        res = self._view_request(self._query())
         # res looks like: {offset: 0, total_rows: 100, rows: [{doc: {document data}, id: foobar, key: returnedkey, value: emittedvalue}, ...]}
-        self._total = res['total_rows']
-        self._data = [self.db._class_for_data(row['doc'], self.model)(**row['doc']) for row in res['rows']]
+        rows = res['rows']
+        if self._whole_view():
+            self._count = res['total_rows']
+        self._next = None
+        if self.use_startkey and self.limitnum is not None and len(rows) > self.limitnum:
+            self._next = (rows[self.limitnum]['key'], rows[self.limitnum]['id'])
+            rows = rows[:self.limitnum]
+        # Rows from the response cache are shared with the next responses
+        self._data = self._load_rows(rows, self.db.response_cache is not None)
 
         return self
 
+    def _load_rows(self, rows, shared = False):
+        if self._rows:
+            copy_value = lingo._copy_json if shared else (lambda value: value)
+            return [ViewRow(row['key'], copy_value(row['value']), row.get('id')) for row in rows]
+        started = time.time()
+        if self._fields is None:
+            out = [self.db._merge(self.db._class_for_data(row['doc'], self.model)._load(row['doc'], shared = shared)) for row in rows]
+        else:
+            out = [self._load_value(row, shared) for row in rows]
+        self.db._record('hydrate', self.db._url_template('/' + self.db.dbname + self._url()), self.model, time.time() - started)
+        self.db._prefetch(out, self._prefetch_fields)
+        return out
+
+    def iter_rows(self):
+        """\
+        Yields the raw rows of the current page (or of the whole view, without a limit),
+        parsed from the response as it arrives instead of after reading all of it
+        """
+        method, body, headers = self._view_body()
+        return self.db._stream_rows(method, self._url(), self._query(), body, headers, model = self.model)
+
+    def _iter_rows_by_key(self, page_size):
+        if self.keys is not None:
+            raise DatabaseError("Keys cannot be combined with key-based pagination")
+        method, body, headers = self._view_body()
+        query = self._query()
+        query.pop('skip', None)
+        query['limit'] = page_size + 1
+        while True:
+            rows = self.db._stream_rows(method, self._url(), query, body, headers, model = self.model)
+            following = None
+            try:
+                for num, row in enumerate(rows):
+                    if num == page_size:
+                        # The first row of the next page is the last of the response;
+                        # reading on to the end lets the connection go back to the pool
+                        following = row
+                    else:
+                        yield row
+            finally:
+                rows.close()
+            if following is None:
+                return
+            query['startkey'] = json.dumps(following['key'])
+            query['startkey_docid'] = following['id']
+
+    def stream(self, batch_size = 100, page_size = None):
+        """\
+        Yields the models of the view one at a time without holding on to them: rows are
+        parsed from the socket as they arrive and hydrated (and prefetched) batch_size at
+        a time, so memory is bounded by the batch and not by the size of the view.  With
+        page_size, the view is read from the current position to the end of its range in
+        requests of page_size rows, paging by key, rather than in one long response.
+        """
+        rows = self.iter_rows() if page_size is None else self._iter_rows_by_key(page_size)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                for instance in self._load_rows(batch):
+                    yield instance
+                batch = []
+        for instance in self._load_rows(batch):
+            yield instance
+
+    def _load_value(self, row, shared = False):
+        if not isinstance(row['value'], dict):
+            raise DatabaseError("View %s does not emit objects and cannot be used for partial models" % (self.view,))
+        data = dict(row['value'])
+        data['_id'] = row['id']
+        return self.db._class_for_data(data, self.model)._load(data, self._fields, shared)
+
     def _get_data(self):
         if self._data is None:
             self.fetch()
@@ -205,10 +898,374 @@ class CouchDBViewResult(object):
     def __contains__(self, item):
         return self._get_data().__contains__(item)
 
+class CouchDBMangoResult(object):
+    """\
+    The documents matching a Mango selector (CouchDB 2.0 and up), fetched lazily
+    with _find.  The selector is restricted to the documents of the model (by their
+    type field).  Pages are walked with bookmarks: next_page() moves to the page
+    after the current one, and next_page_token can be kept to resume from it later.
+    Like CouchDB, _find returns at most 25 documents unless given a limit.
+    """
+    def __init__(self, db, model, selector, fields = None, sort = None, limit = None, bookmark = None, use_index = None):
+        self.db = db
+        self.model = model
+        self.selector = selector
+        self.sortspec = sort
+        self.limitnum = limit
+        self.bookmark = bookmark
+        self.use_index = use_index
+
+        self._data = None
+        self._next = None  # The bookmark of the next page
+        self._prefetch_fields = []
+        self._fields = None if fields is None else model._field_subset(only = fields)
+
+    def prefetch(self, *fields):
+        """Resolve the named reference fields of every fetched document in bulk"""
+        self._prefetch_fields.extend(fields)
+        self._data = None
+        return self
+
+    def only(self, *fields):
+        """Build partial models holding only the named fields (and _id), projected by CouchDB"""
+        self._fields = self.model._field_subset(only = fields)
+        self._data = None
+        return self
+
+    def exclude(self, *fields):
+        """Build partial models holding every field except those named"""
+        self._fields = self.model._field_subset(exclude = fields)
+        self._data = None
+        return self
+
+    def sort(self, *fields):
+        """Sort by the named fields, each either a name or {name: 'asc' or 'desc'}; an index must cover them"""
+        self.sortspec = list(fields) or None
+        self.bookmark = None
+        self._data = None
+        return self
+
+    def limit(self, limit):
+        self.limitnum = limit
+        self._data = None
+        return self
+
+    def page_token(self, token):
+        """Move to the page identified by a token from next_page_token"""
+        self.bookmark = token
+        self._data = None
+        return self
+
+    @property
+    def next_page_token(self):
+        """An opaque token for the page after this one (see page_token()), or None if this is the last page"""
+        self._get_data()
+        return self._next
+
+    def next_page(self):
+        """Move to the next page; returns None, leaving the current page alone, if this is the last one"""
+        token = self.next_page_token
+        if token is None:
+            return None
+        return self.page_token(token)
+
+    def _selector(self):
+        types = sorted(set(cls.get_type_name() for cls in [self.model] + _all_subclasses(self.model)))
+        return {'$and': [{'type': types[0] if len(types) == 1 else {'$in': types}}, self.selector]}
+
+    def _sort(self):
+        if not self.sortspec:
+            return None
+        sort = [field if isinstance(field, dict) else {field: 'asc'} for field in self.sortspec]
+        # The type is the same for every document (or a few), so sorting on it first
+        # changes nothing, but lets CouchDB use the indexes of sync_indexes() for the sort
+        if 'type' not in sort[0]:
+            sort.insert(0, {'type': sort[0].values()[0]})
+        return sort
+
+    def _body(self):
+        body = {'selector': self._selector()}
+        if self._fields is not None:
+            body['fields'] = sorted(self._fields | set(['_id', '_rev', 'type']))
+        sort = self._sort()
+        if sort:
+            body['sort'] = sort
+        if self.limitnum is not None:
+            body['limit'] = self.limitnum
+        if self.bookmark is not None:
+            body['bookmark'] = self.bookmark
+        if self.use_index is not None:
+            body['use_index'] = self.use_index
+        return body
+
+    def _find_request(self, url):
+        return self.db._request_db('POST', url, None, json.dumps(self._body()), {'Content-type': 'application/json'}, model = self.model, retry_safe = True).parsed_body
+
+    def explain(self):
+        """How CouchDB would run the query: the index it would use and the options it was given"""
+        return self._find_request('/_explain')
+
+    def fetch(self):
+        res = self._find_request('/_find')
+        if res.get('warning'):
+            log.warning("%s: %s", self.model.get_type_name(), res['warning'])
+        docs = res['docs']
+        # Without a limit, CouchDB returns its default of 25 documents a page
+        limit = 25 if self.limitnum is None else self.limitnum
+        self._next = res.get('bookmark') if docs and len(docs) >= limit else None
+
+        started = time.time()
+        self._data = [self.db._merge(self.db._class_for_data(doc, self.model)._load(doc, self._fields)) for doc in docs]
+        self.db._record('hydrate', self.db._url_template('/' + self.db.dbname + '/_find'), self.model, time.time() - started)
+        self.db._prefetch(self._data, self._prefetch_fields)
+        return self
+
+    def _get_data(self):
+        if self._data is None:
+            self.fetch()
+        return self._data
+
+    def __len__(self):
+        return len(self._get_data())
+
+    def __getitem__(self, key):
+        return self._get_data().__getitem__(key)
+
+    def __iter__(self):
+        return self._get_data().__iter__()
+
+    def __contains__(self, item):
+        return self._get_data().__contains__(item)
+
+class CouchDBMultiGetResult(list):
+    def __init__(self, *args):
+        super(CouchDBMultiGetResult, self).__init__(*args)
+        self.missing = []
+        self.deleted = []
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _decompressor(res):
+    """A zlib decompressor for the Content-Encoding of a response, or None if it is not compressed"""
+    if res.getheader('Content-Encoding') in ('gzip', 'deflate'):
+        # Accepts both the gzip and the zlib format
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    return None
+
+def _read_body(res):
+    body = res.read()
+    decompressor = _decompressor(res)
+    if decompressor is not None:
+        body = decompressor.decompress(body) + decompressor.flush()
+    return body
+
+class _DecompressingReader(object):
+    """Decompresses a response as it is read"""
+    def __init__(self, fp, decompressor):
+        self.fp = fp
+        self.decompressor = decompressor
+
+    def read(self, size):
+        while True:
+            data = self.fp.read(size)
+            if not data:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+def _iter_response_lines(res):
+    """\
+    Yields the lines of a response as they arrive, without waiting for a read buffer to
+    fill up, which is what HTTPResponse.read does with chunked responses
+    """
+    if not res.chunked:
+        while True:
+            line = res.fp.readline()
+            if not line:
+                return
+            yield line.rstrip('\r\n')
+    buf = ''
+    while True:
+        size = int(res.fp.readline().split(';', 1)[0], 16)
+        if size == 0:
+            return
+        buf += res.fp.read(size)
+        res.fp.read(2)
+        lines = buf.split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+
+class CouchDBChanges(object):
+    """\
+    An iterable over the changes feed of a database.  last_seq is the sequence of the
+    last change iterated over (including changes left out by the types filter), which
+    is where to resume from.  The longpoll and continuous feeds never run out of
+    changes: they wait for more until stop() is called, which takes effect when the
+    current poll returns (after timeout milliseconds) or, for the continuous feed, at
+    the next change or heartbeat (every heartbeat milliseconds).
+    """
+    FEEDS = ('normal', 'longpoll', 'continuous')
+
+    def __init__(self, db, model = None, since = 0, feed = 'normal', heartbeat = None, timeout = None, types = None, include_docs = True, limit = None):
+        if feed not in self.FEEDS:
+            raise DatabaseError("Unsupported changes feed: %s" % (feed,))
+        if types is not None and not include_docs:
+            raise DatabaseError("Changes can only be filtered by type when documents are included")
+        self.db = db
+        self.model = model
+        self.last_seq = since
+        self.feed = feed
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.include_docs = include_docs
+        self.limit = limit
+        self.type_names = None
+        if types is not None:
+            self.type_names = set()
+            for t in types:
+                if isinstance(t, basestring):
+                    self.type_names.add(t)
+                else:
+                    self.type_names.update(cls.get_type_name() for cls in [t] + _all_subclasses(t))
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def _query(self):
+        query = {'feed': self.feed, 'since': self.last_seq}
+        if self.include_docs:
+            query['include_docs'] = 'true'
+        for k in ('heartbeat', 'timeout', 'limit'):
+            if getattr(self, k) is not None:
+                query[k] = getattr(self, k)
+        return query
+
+    def _change(self, row):
+        """The Change for a row of the feed, or None if it is filtered out"""
+        self.last_seq = row['seq']
+        deleted = row.get('deleted', False)
+        doc = row.get('doc')
+        instance = None
+        if doc and not deleted:
+            if self.type_names is not None and doc.get('type') not in self.type_names:
+                return None
+            cls = self.db._class_for_data(doc, self.model)
+            if cls is not None:
+                instance = self.db._merge(cls._load(doc))
+        rev = row['changes'][0]['rev'] if row.get('changes') else None
+        return Change(row['seq'], row['id'], rev, deleted, instance)
+
+    def __iter__(self):
+        if self.feed == 'continuous':
+            return self._iter_continuous()
+        return self._iter_polls()
+
+    def _iter_polls(self):
+        while not self._stopped:
+            res = self.db._request_db('GET', '/_changes', self._query(), model = self.model).parsed_body
+            for row in res['results']:
+                change = self._change(row)
+                if change is not None:
+                    yield change
+            self.last_seq = res['last_seq']
+            if self.feed == 'normal':
+                return
+
+    def _iter_continuous(self):
+        # Read uncompressed, line by line as changes arrive
+        conn, res = self.db._open_stream('GET', '/' + self.db.dbname + '/_changes', self._query(), headers = {'Accept-Encoding': 'identity'}, model = self.model)
+        try:
+            for line in _iter_response_lines(res):
+                if self._stopped:
+                    return
+                if not line.strip():
+                    # A heartbeat
+                    continue
+                row = json.loads(line)
+                if 'seq' not in row:
+                    # {"last_seq": ...}: the feed timed out
+                    self.last_seq = row.get('last_seq', self.last_seq)
+                    return
+                change = self._change(row)
+                if change is not None:
+                    yield change
+        finally:
+            # The response is never read to the end
+            self.db.pool.put(conn, discard = True)
+
+class ChangesConsumer(threading.Thread):
+    """\
+    Follows the continuous changes feed of a database on a daemon thread, calling
+    callback(change) for each change, in order.  last_seq only moves past a change once
+    its callback is done with it, and the feed is reopened from there (after retry_delay
+    seconds) whenever it fails, so no change is missed, though one may be seen twice.
+    Errors, from the feed or the callback, are logged and passed to on_error(exception)
+    if given; a callback failing does not stop the consumer.
+    """
+    def __init__(self, db, callback, since = None, types = None, include_docs = True, heartbeat = 5000, retry_delay = 1.0, on_error = None):
+        super(ChangesConsumer, self).__init__(name = 'lingo-changes-%s' % (db.dbname,))
+        self.daemon = True
+        self.db = db
+        self.callback = callback
+        self.last_seq = since
+        self.types = types
+        self.include_docs = include_docs
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+        self.feed = None
+        self._stop_event = threading.Event()
+
+    def stop(self, timeout = None):
+        """Stop following the feed, waiting up to timeout seconds for the thread to finish"""
+        self._stop_event.set()
+        if self.feed is not None:
+            self.feed.stop()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def _error(self, e):
+        log.error("Changes consumer for %s failed: %s: %s" % (self.db.dbname, e.__class__.__name__, str(e)))
+        if self.on_error is not None:
+            try:
+                self.on_error(e)
+            except Exception as e:
+                log.error("Changes consumer error handler failed: %s: %s" % (e.__class__.__name__, str(e)))
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.last_seq is None:
+                    self.last_seq = self.db._request_db('GET', '').parsed_body['update_seq']
+                self.feed = CouchDBChanges(self.db, None, self.last_seq, 'continuous', self.heartbeat, None, self.types, self.include_docs)
+                if self._stop_event.is_set():
+                    break
+                for change in self.feed:
+                    try:
+                        self.callback(change)
+                    except Exception as e:
+                        self._error(e)
+                    self.last_seq = change.seq
+                self.last_seq = self.feed.last_seq
+            except Exception as e:
+                self._error(e)
+                self._stop_event.wait(self.retry_delay)
+
+# Requests that can be sent again when the connection fails after they were sent:
+# repeating them leaves the database as a single one would
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
 class CouchDB(Database):
     _subclass_map = {}
+    bulk_batch_size = 500
+    _mango_result = CouchDBMangoResult
 
-    def __init__(self, host, dbname, sync_views = True, name = None):
+    def __init__(self, host, dbname, sync_views = True, name = None, pool_size = 10, pool_block = True, pool_timeout = None, idle_timeout = 60, pool_warm = 0, warm_views = False, id_generator = None, response_cache = 0, compression = False, compress_min_size = 1024, gather_workers = None):
         super(CouchDB, self).__init__(name)
         res = urlparse(host)
         if res.scheme != 'http':
@@ -222,60 +1279,291 @@ class CouchDB(Database):
         self.dbname = dbname
 
         self.default_headers = {'Connection': 'keep-alive'}
-        self.threadlocal = threading.local()
-
-        self._get_connection(True, sync_views, True)
-
-    def _get_connection(self, test_conn = False, sync_views = False, reconnect = False):
-        if reconnect or not hasattr(self.threadlocal, 'conn'):
-            if hasattr(self.threadlocal, 'conn'):
-                self.threadlocal.conn.close()
-            self.threadlocal.conn = httplib.HTTPConnection(self.host, self.port)
-            self.threadlocal.conn.connect()
-
-        if test_conn:
-            server_info = self._request('GET', '/').parsed_body
-            assert 'couchdb' in server_info
-            assert server_info['couchdb'] == 'Welcome'
-
+        # Connections are shared by every thread using this database, see ConnectionPool
+        self.pool = ConnectionPool(self.host, self.port, maxsize = pool_size, block = pool_block, timeout = pool_timeout, idle_timeout = idle_timeout)
+        # Called with no arguments for the id of each new document, e.g. time_ordered_id
+        self.id_generator = id_generator or UUIDPool(self)
+        # The ETag and parsed body of up to response_cache documents and view pages, by
+        # URL; responses from it are shared and must not be modified
+        self.response_cache = LRUCache(response_cache) if response_cache else None
+        self._cache_lock = threading.Lock()
+        # With compression, responses are requested gzipped, and JSON request bodies of
+        # at least compress_min_size bytes are sent gzipped
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        # The threads gather() runs requests on, started when it is first used; as
+        # many as there are pooled connections by default
+        self.gather_workers = gather_workers or pool_size
+        self._gather_pool = None
+        self._gather_lock = threading.Lock()
+
+        self._check_server()
+        if pool_warm:
+            self.pool.warm(pool_warm)
         if sync_views:
-            self.sync_views()
+            self._sync(warm_views)
+
+    def _sync(self, warm_views):
+        self.sync_views(warm_views)
+        if self.has_mango():
+            self.sync_indexes()
+        elif self._declared_indexes():
+            log.warning("CouchDB %s does not support Mango, the __Indexes__ of the models were not created", self.server_version)
+
+    def _init_worker(self):
+        self._local.worker = True
+
+    def _gather_executor(self):
+        with self._gather_lock:
+            if self._gather_pool is None:
+                self._gather_pool = ThreadPool(self.gather_workers, self._init_worker)
+            return self._gather_pool
+
+    def gather(self, *calls, **kwargs):
+        """\
+        Run independent requests at once, each on a worker thread over its own pooled
+        connection, and return their results in the same order, so that they take as
+        long as the slowest rather than all of them put together:
+            pages, recent, user = db.gather(
+                Page.database().find('bySection', section),
+                Post.database().find('byDate', limit = 10),
+                lambda: User.database().get(user_id))
+        Each call is either a view or Mango result, which is fetched (its result is
+        itself), or a function taking no arguments.  A call that fails has the
+        exception it raised as its result, unless raise_errors is set, in which case
+        the first one is raised once every call is done.  The calls run outside of
+        the calling thread's session.
+        """
+        raise_errors = kwargs.pop('raise_errors', False)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" % (', '.join(sorted(kwargs)),))
+
+        def run(call):
+            try:
+                return True, call.fetch() if hasattr(call, 'fetch') else call()
+            except Exception as e:
+                return False, e
 
-        return self.threadlocal.conn
+        if len(calls) < 2 or getattr(self._local, 'worker', False):
+            # Nothing to overlap, or already on a worker, which must not wait for the others
+            outcomes = [run(call) for call in calls]
+        else:
+            outcomes = self._gather_executor().map(run, calls, 1)
+        results = []
+        for ok, result in outcomes:
+            if not ok and raise_errors:
+                raise result
+            results.append(result)
+        return results
+
+    def close(self):
+        """Stop the workers of gather(), and close the idle connections"""
+        with self._gather_lock:
+            executor, self._gather_pool = self._gather_pool, None
+        if executor is not None:
+            executor.close()
+            executor.join()
+        self.pool.clear()
+
+    def _check_server(self):
+        server_info = self._request('GET', '/').parsed_body
+        assert 'couchdb' in server_info
+        assert server_info['couchdb'] == 'Welcome'
+        self.server_version = server_info.get('version')
+
+    def has_mango(self):
+        """Whether the server supports Mango queries and indexes (CouchDB 2.0 and up)"""
+        major = re.match(r'\d+', self.server_version or '')
+        return major is not None and int(major.group(0)) >= 2
+
+    def _check_mango(self):
+        if not self.has_mango():
+            raise DatabaseError("Mango queries and indexes need CouchDB 2.0 or later, the server runs %s" % (self.server_version,))
+
+    def _url_template(self, url):
+        """The URL with database names, document ids and attachment names replaced by placeholders, for instrumentation"""
+        parts = url.split('?')[0].split('/')
+        out = []
+        for i, part in enumerate(parts):
+            if not part or part.startswith('_') or (i > 1 and parts[i - 1] in ('_design', '_view', '_show', '_list', '_update')):
+                out.append(part)
+            elif i == 1:
+                out.append('{db}')
+            else:
+                out.append('{id}' if i == 2 else '{name}')
+        return '/'.join(out)
 
-    def _request(self, method, url, query = {}, body = None, headers = {}, parse_body = True):
+    def _headers(self, headers):
         real_headers = {}
         real_headers.update(self.default_headers)
+        if self.compression:
+            real_headers['Accept-Encoding'] = 'gzip'
         real_headers.update(headers)
         if self.username or self.password:
             real_headers.update({'Authorization': 'Basic %s' % (base64.b64encode('%s:%s' % (self.username or '', self.password or '')))})
+        return real_headers
+
+    def _encode_body(self, body, headers):
+        """The body to send, gzipped if it is JSON large enough for compression to pay off"""
+        if self.compression and body is not None and len(body) >= self.compress_min_size and headers.get('Content-type') == 'application/json':
+            headers['Content-Encoding'] = 'gzip'
+            return _gzip(body)
+        return body
+
+    def _request(self, method, url, query = {}, body = None, headers = {}, parse_body = True, model = None, cache = False, retry_safe = None):
+        """\
+        Send a request, retrying when the connection fails.  Unless retry_safe (by
+        default, whether the method is one of _IDEMPOTENT_METHODS), e.g. for a POST to
+        _bulk_docs, requests are only retried if the connection failed before they
+        were sent, since the server may have acted on them otherwise; POSTs that only
+        read (keys, _find) pass retry_safe = True.  With cache, and if the response cache is enabled, GET
+        responses carrying an ETag are kept, and the next request for the same URL
+        asks the server whether they are still current (If-None-Match): if so (304
+        Not Modified), the cached parse is returned.
+        """
+        real_headers = self._headers(headers)
+        body = self._encode_body(body, real_headers)
+        if retry_safe is None:
+            retry_safe = method in _IDEMPOTENT_METHODS
         max_tries = 3
-        for try_num in range(0, max_tries):
-            try:
-                qs = ''
-                if query is not None:
-                    qs = '?' + urllib.urlencode(query)
-                self._get_connection().request(method, str(url + qs), body, real_headers)
-                res = self._get_connection().getresponse()
-            except (httplib.CannotSendRequest, httplib.BadStatusLine) as e:
-                self._get_connection(reconnect = True)
-                continue
-
+        target = self._url_template(url)
+        qs = ''
+        if query is not None:
+            qs = '?' + urllib.urlencode(query)
+        cache_key = cached = None
+        if cache and self.response_cache is not None and method == 'GET' and parse_body:
+            cache_key = str(url + qs)
+            with self._cache_lock:
+                cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                real_headers['If-None-Match'] = cached[0]
+        started = time.time()
+        retries = 0
+        try:
+            for try_num in range(0, max_tries):
+                conn = self.pool.get()
+                sent = False
+                try:
+                    conn.request(method, str(url + qs), body, real_headers)
+                    sent = True
+                    res = conn.getresponse()
+                    res.body = _read_body(res)
+                except (httplib.CannotSendRequest, httplib.BadStatusLine, socket.error) as e:
+                    self.pool.put(conn, discard = True)
+                    if sent and not retry_safe:
+                        raise DatabaseError("%s %s failed (%s) after it was sent, and cannot be retried safely" % (method, target, e.__class__.__name__))
+                    retries += 1
+                    log.warning("%s %s failed (%s), reconnecting (try %d of %d)" % (method, target, e.__class__.__name__, try_num + 1, max_tries))
+                    continue
+                except:
+                    self.pool.put(conn, discard = True)
+                    raise
+                self.pool.put(conn)
+
+                if res.status < 200 or res.status >= 400:
+                    ex = DatabaseError("%d %s" % (res.status, res.reason))
+                    ex.body = res.body
+                    ex.parsed_body = json.loads(ex.body) if parse_body else None
+                    ex.response = res
+                    raise ex
+                else:
+                    self._record(method, target, model, time.time() - started, retries)
+                    break
+            else:
+                raise DatabaseError("Connection to the database failed after %d tries" % (max_tries,))
+        except Exception as e:
+            self._record(method, target, model, time.time() - started, retries, e)
+            raise
+
+        res.parsed_body = None
+        if res.status == 304 and cached is not None:
+            res.parsed_body = cached[1]
+        elif parse_body:
+            started = time.time()
+            res.parsed_body = json.loads(res.body)
+            self._record('decode', target, model, time.time() - started)
+            if cache_key is not None and res.getheader('ETag'):
+                with self._cache_lock:
+                    self.response_cache.put(cache_key, (res.getheader('ETag'), res.parsed_body))
+        return res
+
+    def _request_db(self, method, url, query = {}, body = None, headers = {}, parse_body = True, model = None, cache = False, retry_safe = None):
+        return self._request(method, '/' + self.dbname + url, query, body, headers, parse_body, model, cache, retry_safe)
+
+    def _open_stream(self, method, url, query = {}, body = None, headers = {}, model = None):
+        """\
+        Send a request over a connection checked out of the pool and return the
+        connection and the response, unread; the connection must be returned to the
+        pool once the response has been consumed
+        """
+        target = self._url_template(url)
+        started = time.time()
+        real_headers = self._headers(headers)
+        body = self._encode_body(body, real_headers)
+        conn = self.pool.get()
+        try:
+            conn.request(method, str(url + '?' + urllib.urlencode(query or {})), body, real_headers)
+            res = conn.getresponse()
             if res.status < 200 or res.status >= 400:
                 ex = DatabaseError("%d %s" % (res.status, res.reason))
-                ex.body = res.read()
-                ex.parsed_body = json.loads(ex.body) if parse_body else None
+                ex.body = _read_body(res)
+                ex.parsed_body = json.loads(ex.body)
                 ex.response = res
                 raise ex
-            else:
-                res.body = res.read()
-                res.parsed_body = json.loads(res.body) if parse_body else None
-                return res
-
-        raise DatabaseError("Connection to the database failed after %d tries" % (max_tries,))
-
-    def _request_db(self, method, url, query = {}, body = None, headers = {}, parse_body = True):
-        return self._request(method, '/' + self.dbname + url, query, body, headers, parse_body)
+        except Exception as e:
+            self.pool.put(conn, discard = True)
+            self._record(method, target, model, time.time() - started, 0, e)
+            raise
+        self._record(method, target, model, time.time() - started)
+        return conn, res
+
+    def _stream_rows(self, method, url, query = {}, body = None, headers = {}, model = None):
+        """\
+        Yields the rows of a view as they are read from the response.  The connection
+        stays checked out of the pool until the generator is exhausted or closed, so
+        that other requests can go on while it is consumed; it is discarded if the
+        response was not read to the end.
+        """
+        url = '/' + self.dbname + url
+        target = self._url_template(url)
+        conn, res = self._open_stream(method, url, query, body, headers, model)
+        done = False
+        try:
+            started = time.time()
+            decompressor = _decompressor(res)
+            for row in _iter_view_rows(res if decompressor is None else _DecompressingReader(res, decompressor)):
+                yield row
+            # Whatever follows the rows, so that the connection can be reused
+            res.read()
+            done = True
+            self._record('stream', target, model, time.time() - started)
+        finally:
+            self.pool.put(conn, discard = not done)
+
+    def changes(self, model = None, since = 0, feed = 'normal', heartbeat = None, timeout = None, types = None, include_docs = True, limit = None):
+        """\
+        The changes feed of the database, as an iterable of Change.  With the normal
+        feed the changes since the sequence since are read once; longpoll and continuous
+        feeds follow the database until stop() is called on the feed, waiting for new
+        changes (see CouchDBChanges).  types limits the changes to documents of those
+        models (or type names) and their subclasses, and defaults to the model when
+        called through one; deletions are always included, as deleted documents carry
+        no type.
+        """
+        if types is None and model is not None:
+            types = [model]
+        return CouchDBChanges(self, model, since, feed, heartbeat, timeout, types, include_docs, limit)
+
+    def follow_changes(self, model, callback, since = None, types = None, include_docs = True, heartbeat = 5000, retry_delay = 1.0, on_error = None):
+        """\
+        Start a ChangesConsumer, calling callback(change) from a background thread for
+        every change after since (by default, from now on)
+        """
+        if types is None and model is not None:
+            types = [model]
+        consumer = ChangesConsumer(self, callback, since, types, include_docs, heartbeat, retry_delay, on_error)
+        consumer.start()
+        return consumer
 
     def create_db(self, dbname):
         return self._request('PUT', '/' + dbname)
@@ -286,98 +1574,336 @@ class CouchDB(Database):
     def _get_uuids(self, count = 1):
         return self._request('GET', '/_uuids', dict(count = count)).parsed_body['uuids']
 
-    def save(self, model_instance):
+    def _check_saveable(self, model_instance):
         if model_instance.__class__._clsattr("__Embedded__"):
             raise ModelError("Model %s is embedded and cannot be saved"%(model_instance.__class__.__name__,))
+        if model_instance.is_partial():
+            raise ModelError("Model %s was partially loaded and cannot be saved to CouchDB" % (model_instance.__class__.__name__,))
+
+    def _needs_save(self, model_instance):
+        if model_instance.__raw__ is not None and model_instance._id and not model_instance.is_dirty():
+            return any(a._new or a._deleted for a in model_instance._attachments.values())
+        return True
+
+    def _rev_of(self, model_instance):
+        """The revision of an instance: None if it was never saved, and for models without a _rev field unless one was set"""
+        if '_rev' not in model_instance._get_schema().fields:
+            return model_instance.__dict__.get('_rev')
+        return model_instance._rev
+
+    def _saved(self, model_instance, data):
+        data.update(_id = model_instance._id, _rev = self._rev_of(model_instance))
+        model_instance._mark_clean(data)
+        if self._get_session() is not None:
+            self._get_session().add(model_instance)
+
+    def assign_id(self, model_instance):
+        """\
+        Give an instance that has no id yet one from id_generator, e.g. to reference
+        it from other documents before saving it; returns the id
+        """
+        if not model_instance._id:
+            model_instance._id = self.id_generator()
+        return model_instance._id
+
+    def save(self, model_instance):
+        self._check_saveable(model_instance)
+        if not self._needs_save(model_instance):
+            return model_instance._id
         if not model_instance.touch():
             raise ModelError("touch() failed")
         skip = ['_id']
-        _id = model_instance._id
+        # New documents get their id here rather than from a POST, so that saving them
+        # again after a failure cannot create a duplicate
+        _id = self.assign_id(model_instance)
         headers = {'Content-type': 'application/json'}
         typename = model_instance.__class__.get_type_name()
         attachment_stubs = {'_attachments': {k: v._asdict() for k, v in model_instance._attachments.items() if not v._new}}
-        if not _id:
+        if not self._rev_of(model_instance):
             skip.append('_rev')
-            data = model_instance._asdict(skip = skip, extra = {'type': typename})
-            data.update(attachment_stubs)
-            res = self._request_db(
-                'POST',
-                '/',
-                {},
-                json.dumps(data),
-                headers
-            ).parsed_body
-        else:
-            data = model_instance._asdict(skip = skip, extra = {'type': typename})
-            data.update(attachment_stubs)
-            res = self._request_db(
-                'PUT',
-                '/' + _id,
-                {},
-                json.dumps(data),
-                headers
-            ).parsed_body
+        data = model_instance._asdict(skip = skip, extra = {'type': typename})
+        data.update(attachment_stubs)
+        res = self._request_db(
+            'PUT',
+            '/' + _id,
+            {},
+            json.dumps(data),
+            headers,
+            model = model_instance.__class__
+        ).parsed_body
         model_instance._id = res['id']
         model_instance._rev = res['rev']
         deleted_attachments = []
         for attachment in model_instance._attachments.values():
             if attachment._new:
-                res = self._request_db('PUT', '/' + model_instance._id + '/' + attachment.name, {'rev': model_instance._rev}, attachment.data, {'Content-type': attachment.content_type})
+                res = self._request_db('PUT', '/' + model_instance._id + '/' + attachment.name, {'rev': model_instance._rev}, attachment.data, {'Content-type': attachment.content_type}, model = model_instance.__class__)
                 attachment._new = False
             elif attachment._deleted:
-                res = self._request_db('DELETE', '/' + model_instance._id + '/' + attachment.name, {'rev': model_instance._rev})
+                res = self._request_db('DELETE', '/' + model_instance._id + '/' + attachment.name, {'rev': model_instance._rev}, model = model_instance.__class__)
                 deleted_attachments.append(attachment.name)
             else:
                 continue
             model_instance._rev = res.parsed_body['rev']
         for name in deleted_attachments:
             del model_instance._attachments[name]
+        self._saved(model_instance, data)
         return model_instance._id
 
+    def _bulk_request(self, model, docs):
+        return self._request_db('POST', '/_bulk_docs', {}, json.dumps({'docs': docs}), {'Content-type': 'application/json'}, model = model).parsed_body
+
+    def save_many(self, model, instances, batch_size = None):
+        """\
+        Save instances through _bulk_docs, batch_size (bulk_batch_size by default) at
+        a time, with attachments inlined.  Returns a BulkResult for every instance,
+        in order; documents rejected by the database (e.g. conflicts) are reported
+        there instead of raising.
+        """
+        for instance in instances:
+            self._check_saveable(instance)
+        batch_size = batch_size or self.bulk_batch_size
+        results = []
+        for start in range(0, len(instances), batch_size):
+            batch = []
+            for instance in instances[start:start + batch_size]:
+                if self._needs_save(instance):
+                    if not instance.touch():
+                        raise ModelError("touch() failed")
+                    batch.append(instance)
+            docs = []
+            for instance in batch:
+                data = instance._asdict(skip = ['_id', '_rev'], extra = {'type': instance.__class__.get_type_name()})
+                data['_attachments'] = {k: v._asdict(with_data = v._new) for k, v in instance._attachments.items() if not v._deleted}
+                doc = dict(data)
+                doc['_id'] = self.assign_id(instance)
+                rev = self._rev_of(instance)
+                if rev:
+                    doc['_rev'] = rev
+                docs.append((instance, data, doc))
+            written = {}
+            if docs:
+                for (instance, data, doc), row in zip(docs, self._bulk_request(model, [doc for _, _, doc in docs])):
+                    if 'error' in row:
+                        written[id(instance)] = BulkResult(instance, instance._id, self._rev_of(instance), row['error'], row.get('reason'))
+                        continue
+                    instance._id = row['id']
+                    instance._rev = row['rev']
+                    for name, attachment in instance._attachments.items():
+                        if attachment._deleted:
+                            del instance._attachments[name]
+                        attachment._new = False
+                    self._saved(instance, data)
+                    written[id(instance)] = BulkResult(instance, instance._id, self._rev_of(instance), None, None)
+            for instance in instances[start:start + batch_size]:
+                results.append(written.get(id(instance)) or BulkResult(instance, instance._id, self._rev_of(instance), None, None))
+        return results
+
+    def delete_many(self, model, instances, batch_size = None):
+        """\
+        Delete instances through _bulk_docs; returns a BulkResult for every instance,
+        in order, with the revision of the deletion.  Instances that were never saved
+        are skipped.
+        """
+        for instance in instances:
+            if instance.__class__._clsattr("__Embedded__"):
+                raise ModelError("Model %s is embedded and cannot be saved"%(instance.__class__.__name__,))
+        batch_size = batch_size or self.bulk_batch_size
+        results = []
+        for start in range(0, len(instances), batch_size):
+            batch = [i for i in instances[start:start + batch_size] if i._id]
+            written = {}
+            if batch:
+                docs = [{'_id': i._id, '_rev': self._rev_of(i), '_deleted': True} for i in batch]
+                for instance, row in zip(batch, self._bulk_request(model, docs)):
+                    if 'error' in row:
+                        written[id(instance)] = BulkResult(instance, instance._id, self._rev_of(instance), row['error'], row.get('reason'))
+                        continue
+                    if self._get_session() is not None:
+                        self._get_session().remove(instance)
+                    written[id(instance)] = BulkResult(instance, row['id'], row['rev'], None, None)
+            for instance in instances[start:start + batch_size]:
+                results.append(written.get(id(instance)) or BulkResult(instance, instance._id, self._rev_of(instance), None, None))
+        return results
+
     def get(self, model, _id):
+        session = self._get_session() if model is not None else None
+        if session is not None:
+            instance = session.get(model, _id)
+            if instance is not None:
+                return instance
         try:
-            data = self._request_db('GET', '/' + _id).parsed_body
+            data = self._request_db('GET', '/' + _id, model = model, cache = True).parsed_body
+            shared = self.response_cache is not None
             if model is None:
-                return data
+                return copy.deepcopy(data) if shared else data
             else:
-                return model(**data)
+                return self._merge(model._load(data, shared = shared))
         except DatabaseError as e:
             if e.response.status == 404:
                 raise NotFoundError("Not found: %s == %s" % (model.__class__.__name__ if model else '[None]', _id))
             else:
                 raise e
 
-    def find(self, model, view, keys = None):
-        return CouchDBViewResult(self, model, view, keys)
+    def get_many(self, model, ids, chunk_size = None):
+        """\
+        Fetch many documents by id with _all_docs, chunk_size (bulk_batch_size by
+        default) ids per request.  Returns a CouchDBMultiGetResult: the instances in
+        the order of ids, with None for documents that are missing or deleted, which
+        are listed in its missing and deleted attributes.
+        """
+        out = CouchDBMultiGetResult([None] * len(ids))
+        session = self._get_session()
+        pending = {}
+        for i, _id in enumerate(ids):
+            instance = session.get(model, _id) if session is not None else None
+            if instance is not None:
+                out[i] = instance
+            else:
+                pending.setdefault(_id, []).append(i)
+
+        keys = pending.keys()
+        chunk_size = chunk_size or self.bulk_batch_size
+        for start in range(0, len(keys), chunk_size):
+            res = self._request_db('POST', '/_all_docs', {'include_docs': 'true'}, json.dumps({'keys': keys[start:start + chunk_size]}), {'Content-type': 'application/json'}, model = model, retry_safe = True).parsed_body
+            for row in res['rows']:
+                # Missing rows look like {key: ..., error: "not_found"}, deleted ones like {id: ..., key: ..., value: {rev: ..., deleted: true}, doc: null}
+                if row.get('doc'):
+                    instance = self._merge(self._class_for_data(row['doc'], model)._load(row['doc']))
+                    for i in pending[row['key']]:
+                        out[i] = instance
+                elif (row.get('value') or {}).get('deleted'):
+                    out.deleted.append(row['key'])
+                else:
+                    out.missing.append(row['key'])
+        return out
+
+    def _get_by_ids(self, model, ids):
+        return {_id: instance for _id, instance in zip(ids, self.get_many(model, ids)) if instance is not None}
+
+    def find(self, model, view, keys = None, **kwargs):
+        """\
+        Query a view by name, or with a Mango selector (a dict) and the options of
+        CouchDBMangoResult: fields, sort, limit, bookmark and use_index
+        """
+        if isinstance(view, dict):
+            if keys is not None:
+                raise DatabaseError("Keys cannot be combined with a selector")
+            self._check_mango()
+            return self._mango_result(self, model, view, **kwargs)
+        return CouchDBViewResult(self, model, view, keys, **kwargs)
 
-    def sync_views(self):
+    @classmethod
+    def _views_hash(self, views):
+        return hashlib.sha1(json.dumps(views, sort_keys = True)).hexdigest()
+
+    def sync_views(self, warm = False):
+        """\
+        Write the __Views__ of every model to its design document, leaving alone the
+        design documents whose views have not changed: rewriting one makes CouchDB
+        rebuild its index.  Each design document records a hash of the views it was
+        written with (lingo_hash), which is what they are compared by.  With warm, the
+        indexes of the updated design documents start building in the background right
+        away, instead of when a view is first queried.  Returns the ids of the design
+        documents that were written.
+        """
         docs = {}
-        for model in lingo.Model.__subclasses__():
+        for model in _all_subclasses(lingo.Model):
             views = model._clsattr('__Views__')
             if views:
                 id_ = '_design/' + model.get_type_name()
                 if id_ not in docs:
                     docs[id_] = {'views': {}}
                 docs[id_]['views'].update(views)
+        if not docs:
+            return []
+
+        existing = {}
+        res = self._request_db('GET', '/_all_docs', {'startkey': '"_design/"', 'endkey': '"_design0"', 'include_docs': 'true'}).parsed_body
+        for row in res['rows']:
+            if row.get('doc'):
+                existing[row['id']] = row['doc']
+
+        changed = []
+        for id_, doc in sorted(docs.items()):
+            doc['lingo_hash'] = self._views_hash(doc['views'])
+            current = existing.get(id_)
+            if current is not None:
+                if current.get('lingo_hash') == doc['lingo_hash'] or current.get('views') == doc['views']:
+                    continue
+                # Keep whatever else the design document holds (filters, validation...)
+                current.update(doc)
+                doc = current
+            doc['_id'] = id_
+            changed.append(doc)
+        if not changed:
+            return []
+
+        res = self._bulk_request(None, changed)
+        errors = ['%s: %s' % (row.get('id'), row.get('reason') or row['error']) for row in res if 'error' in row]
+        if errors:
+            raise DatabaseError("Could not update the design documents: %s" % (', '.join(errors),))
+
+        if warm:
+            for doc in changed:
+                # Querying any view of a design document builds the index of all of them;
+                # update_after answers right away and builds it after answering
+                self._request_db('GET', '/%s/_view/%s' % (doc['_id'], sorted(doc['views'])[0]), {'limit': 0, 'stale': 'update_after'})
+        return [doc['_id'] for doc in changed]
 
-        # In order to update we need a _rev so let's get that
-        for id_ in docs.keys():
-            try:
-                realdoc = self.get(None, id_)
-                docs[id_]['_rev'] = realdoc['_rev']
-            except NotFoundError:
-                pass
-
-        # Put the results
-        for id_, doc in docs.items():
-            if doc and len(doc):
-                res = self._request_db(
-                    'PUT',
-                    '/' + id_,
-                    {},
-                    json.dumps(doc),
-                    {'Content-type': 'application/json'}
-                ).parsed_body
+    @classmethod
+    def _index_fields(self, fields):
+        return [field if isinstance(field, dict) else {field: 'asc'} for field in fields]
+
+    @classmethod
+    def _declared_indexes(self):
+        """\
+        The Mango indexes of the __Indexes__ of every model, by design document: each
+        maps an index name to its list of fields (names, or {name: 'asc' or 'desc'}),
+        or to an index definition holding them as 'fields' (and optionally a
+        'partial_filter_selector').  The type comes first in every index, since the
+        queries of find() are restricted to one type.
+        """
+        out = {}
+        for model in _all_subclasses(lingo.Model):
+            for name, index in (model._clsattr('__Indexes__') or {}).items():
+                index = dict(index) if isinstance(index, dict) else {'fields': index}
+                fields = self._index_fields(index['fields'])
+                if 'type' not in fields[0]:
+                    fields.insert(0, {'type': fields[0].values()[0]})
+                index['fields'] = fields
+                # One design document per index, so that changing one does not rebuild the others
+                out['_design/lingo-%s-%s' % (model.get_type_name(), name)] = (name, index)
+        return out
+
+    def sync_indexes(self):
+        """\
+        Create the Mango indexes declared in the __Indexes__ of the models that do not
+        exist yet, and replace those whose definition has changed, leaving the rest
+        alone.  Returns the design document ids of the indexes that were written.
+        Raises DatabaseError on servers without Mango (see has_mango()); on those, the
+        constructor skips this step with a warning.
+        """
+        declared = self._declared_indexes()
+        if not declared:
+            return []
+        self._check_mango()
+
+        existing = {}
+        for index in self._request_db('GET', '/_index').parsed_body['indexes']:
+            if index.get('ddoc') in declared:
+                existing[index['ddoc']] = index
+
+        changed = []
+        for ddoc, (name, index) in sorted(declared.items()):
+            current = existing.get(ddoc)
+            if current is not None:
+                definition = current.get('def', {})
+                if current['name'] == name and self._index_fields(definition.get('fields', [])) == index['fields'] and definition.get('partial_filter_selector') == index.get('partial_filter_selector'):
+                    continue
+                self._request_db('DELETE', '/_index/%s/json/%s' % (ddoc[len('_design/'):], current['name']))
+            self._request_db('POST', '/_index', None, json.dumps({'index': index, 'ddoc': ddoc, 'name': name, 'type': 'json'}), {'Content-type': 'application/json'})
+            changed.append(ddoc)
+        return changed
 
     def create_admin(self, username, password):
         return self._request('PUT', '/_config/admins/' + username, None, '"%s"' % (password,))
@@ -404,7 +1930,10 @@ class CouchDB(Database):
         if model_instance.__class__._clsattr("__Embedded__"):
             raise ModelError("Model %s is embedded and cannot be saved"%(model_instance.__class__.__name__,))
         if model_instance._id:
-            return self.delete_document(model_instance._id, model_instance._rev)
+            res = self.delete_document(model_instance._id, model_instance._rev)
+            if self._get_session() is not None:
+                self._get_session().remove(model_instance)
+            return res
 
     def preprocess(self, model_instance, data):
         # Bypass strict mode
@@ -437,7 +1966,7 @@ class CouchDB(Database):
 
     @classmethod
     def _load_subclasses(self):
-        self._subclass_map = {cls.__name__: cls for cls in lingo.Model.__subclasses__()}
+        self._subclass_map = {cls.__name__: cls for cls in _all_subclasses(lingo.Model)}
 
     @classmethod
     def _class_for_data(self, data, model=None):
@@ -447,4 +1976,97 @@ class CouchDB(Database):
                     return self._subclass_map[data['type']]
                 except KeyError:
                     self._load_subclasses()
-        return model
\ No newline at end of file
+        return model
+
+class AsyncCouchDBViewResult(CouchDBViewResult):
+    def fetch(self):
+        return self.db._wait(CouchDBViewResult.fetch, self)
+
+    def fetch_async(self):
+        """Fetch the current page on a worker; the result is this view result, once loaded"""
+        return self.db._submit(CouchDBViewResult.fetch, self)
+
+class AsyncCouchDBMangoResult(CouchDBMangoResult):
+    def fetch(self):
+        return self.db._wait(CouchDBMangoResult.fetch, self)
+
+    def fetch_async(self):
+        """Fetch the current page on a worker; the result is this Mango result, once loaded"""
+        return self.db._submit(CouchDBMangoResult.fetch, self)
+
+def _async_method(name):
+    method = getattr(CouchDB, name)
+    def wrapped(self, *args, **kwargs):
+        return self._submit(method, self, *args, **kwargs)
+    wrapped.__name__ = name
+    wrapped.__doc__ = "Like CouchDB.%s, run on a worker; returns an AsyncResult" % (name,)
+    return wrapped
+
+class AsyncCouchDB(CouchDB):
+    """\
+    A CouchDB whose model-facing operations run on a pool of worker threads and
+    return a multiprocessing.pool.AsyncResult instead of blocking, so that many
+    requests can be in flight at once:
+        pending = [SampleModel.database().get(_id) for _id in ids]
+        instances = [p.get() for p in pending]
+    find() returns a view or Mango result whose fetch_async() loads a page on a
+    worker.  Up to workers operations run at a time, over connections from the
+    connection pool (which is as large by default).  Reference fields and
+    prefetching still load synchronously.  Sessions belong to the thread that
+    opened them, so they do not apply to operations run by the workers.  gather()
+    uses the same workers.
+    """
+    def __init__(self, host, dbname, sync_views = True, name = None, workers = 10, **kwargs):
+        kwargs.setdefault('pool_size', workers)
+        warm_views = kwargs.pop('warm_views', False)
+        super(AsyncCouchDB, self).__init__(host, dbname, False, name, **kwargs)
+        self.executor = ThreadPool(workers, self._init_worker)
+        if sync_views:
+            self._sync(warm_views)
+
+    def _gather_executor(self):
+        return self.executor
+
+    def _submit(self, func, *args, **kwargs):
+        if getattr(self._local, 'worker', False):
+            # Operations that are part of an operation already running on a worker
+            # (e.g. get_many for a prefetch) run in place and return their result
+            return func(*args, **kwargs)
+        return self.executor.apply_async(func, args, kwargs)
+
+    def _wait(self, func, *args, **kwargs):
+        if getattr(self._local, 'worker', False):
+            return func(*args, **kwargs)
+        return self.executor.apply(func, args, kwargs)
+
+    get = _async_method('get')
+    get_many = _async_method('get_many')
+    save = _async_method('save')
+    save_many = _async_method('save_many')
+    delete = _async_method('delete')
+    delete_many = _async_method('delete_many')
+    get_attachment = _async_method('get_attachment')
+    _mango_result = AsyncCouchDBMangoResult
+
+    def find(self, model, view, keys = None, **kwargs):
+        if isinstance(view, dict):
+            return CouchDB.find(self, model, view, keys, **kwargs)
+        return AsyncCouchDBViewResult(self, model, view, keys, **kwargs)
+
+    def _get_reference(self, model, _id):
+        return self._wait(CouchDB.get, self, model, _id)
+
+    def _get_by_ids(self, model, ids):
+        return self._wait(CouchDB._get_by_ids, self, model, ids)
+
+    def sync_views(self, warm = False):
+        return self._wait(CouchDB.sync_views, self, warm)
+
+    def sync_indexes(self):
+        return self._wait(CouchDB.sync_indexes, self)
+
+    def close(self):
+        """Stop the workers once the pending operations are done, and close the idle connections"""
+        self.executor.close()
+        self.executor.join()
+        super(AsyncCouchDB, self).close()
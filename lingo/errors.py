@@ -11,4 +11,7 @@ class ModelError(LingoError):
     pass
 
 class ValidationError(ModelError):
-    pass
\ No newline at end of file
+    pass
+
+class PoolExhaustedError(DatabaseError):
+    pass
@@ -0,0 +1,88 @@
+import threading
+from collections import namedtuple
+
+# One timed database operation, passed to every hook registered with Database.add_hook:
+#	backend: the database class name, e.g. 'CouchDB'
+#	operation: the HTTP method, a pymongo call, or 'decode'/'hydrate' for the time spent
+#		parsing responses and building models ('stream' for reading a streamed view)
+#	target: the URL template (ids replaced by placeholders) or the collection name
+#	model: the type name of the model involved, if any
+#	duration: seconds
+#	retries: how many times the operation had to be retried
+#	error: the exception raised, if it failed
+Operation = namedtuple('Operation', 'backend operation target model duration retries error')
+
+class OperationStats(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.count = 0
+		self.errors = 0
+		self.retries = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.histogram = [0] * (len(buckets) + 1)
+
+	def add(self, event):
+		self.count += 1
+		self.errors += 1 if event.error is not None else 0
+		self.retries += event.retries
+		self.total += event.duration
+		self.max = max(self.max, event.duration)
+		for i, bound in enumerate(self.buckets):
+			if event.duration <= bound:
+				self.histogram[i] += 1
+				break
+		else:
+			self.histogram[-1] += 1
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	def _asdict(self):
+		return dict(
+			count = self.count,
+			errors = self.errors,
+			retries = self.retries,
+			total = self.total,
+			mean = self.mean,
+			max = self.max,
+			histogram = zip([str(b) for b in self.buckets] + ['+Inf'], self.histogram)
+		)
+
+class Stats(object):
+	"""\
+	A hook that keeps counters and a latency histogram for every combination of
+	backend, operation, URL template/collection and model type:
+		stats = Stats()
+		db.add_hook(stats)
+		...
+		print stats.report()
+	"""
+	BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+	def __init__(self, buckets = None):
+		self.buckets = tuple(buckets or self.BUCKETS)
+		self.lock = threading.Lock()
+		self.operations = {}
+
+	def __call__(self, event):
+		key = (event.backend, event.operation, event.target, event.model)
+		with self.lock:
+			if key not in self.operations:
+				self.operations[key] = OperationStats(self.buckets)
+			self.operations[key].add(event)
+
+	def reset(self):
+		with self.lock:
+			self.operations = {}
+
+	def snapshot(self):
+		with self.lock:
+			return {k: v._asdict() for k, v in self.operations.items()}
+
+	def report(self):
+		lines = ["%-8s %-8s %-45s %-20s %8s %6s %7s %9s %9s" % ('backend', 'op', 'target', 'model', 'count', 'errors', 'retries', 'mean ms', 'max ms')]
+		for key, s in sorted(self.snapshot().items(), key = lambda item: -item[1]['total']):
+			lines.append("%-8s %-8s %-45s %-20s %8d %6d %7d %9.2f %9.2f" % (key[0], key[1], key[2], key[3] or '-', s['count'], s['errors'], s['retries'], s['mean'] * 1000, s['max'] * 1000))
+		return '\n'.join(lines)
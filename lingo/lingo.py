@@ -1,6 +1,7 @@
 import functools
 import inspect
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 import mimetypes
 import base64
 import logging
@@ -28,71 +29,147 @@ class combomethod(object):
 				return self.method(objtype, *args, **kwargs)
 		return _wrapper
 
+def _identity(value):
+	return value
+
+def _copy_json(value):
+	"""A copy of a decoded JSON value that shares no dict or list with it"""
+	if isinstance(value, dict):
+		return {k:_copy_json(v) for k,v in value.items()}
+	elif isinstance(value, list):
+		return [_copy_json(v) for v in value]
+	return value
+
+_UTC = pytz.utc
+_EPOCH = datetime(1970, 1, 1, tzinfo = _UTC)
+# Matches what _datetime_to_json emits for UTC values, plus the "Z" and naive forms
+_ISO_UTC_DATETIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(?:Z|[+-]00:00)?$')
+
+def _datetime_to_python(value):
+	match = _ISO_UTC_DATETIME.match(value) if isinstance(value, basestring) else None
+	if match:
+		year, month, day, hour, minute, second, fraction = match.groups()
+		return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), int(fraction.ljust(6, '0')) if fraction else 0, _UTC)
+	out = parse(str(value))
+	if out.tzinfo is None or out.tzinfo.utcoffset(out) is None:
+		out = out.replace(tzinfo = _UTC)
+	return out
+
+def _datetime_to_json(value):
+	if value.tzinfo is None or value.tzinfo.utcoffset(value) is None:
+		value = value.replace(tzinfo = _UTC)
+	return value.isoformat()
+
+def _epoch_to_python(value):
+	if isinstance(value, (int, long, float)):
+		return _EPOCH + timedelta(microseconds = value)
+	return _datetime_to_python(value)
+
+def _epoch_to_json(value):
+	if value.tzinfo is None or value.tzinfo.utcoffset(value) is None:
+		value = value.replace(tzinfo = _UTC)
+	delta = value - _EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
 class Field(object):
-	def __init__(self, ftype=None, fsubtype=None, validation=None, default=None, doc=None):
+	def __init__(self, ftype=None, fsubtype=None, validation=None, default=None, doc=None, epoch=False):
 		self.ftype=ftype
 		self.fsubtype=fsubtype
 		self.validation=validation
 		self.default=default
 		self.doc=doc
+		self.epoch=epoch	#If true, datetimes are stored as integer microseconds since the epoch instead of ISO-8601 strings
+		# The type of a field never changes, so the conversion functions are
+		# specialized once here instead of dispatching on every value
+		self._python_converter=self._compile_to_python()
+		self._json_converter=self._compile_to_json()
+
+	def _compile_to_python(self):
+		if self.ftype is None:
+			return _identity
+		elif inspect.isclass(self.ftype) and issubclass(self.ftype, list):
+			convert = self._compile_scalar_to_python(self.fsubtype, self.epoch)
+			return lambda value: [convert(v) for v in (value if isinstance(value, list) else [value])]
+		elif inspect.isclass(self.ftype) and issubclass(self.ftype, dict):
+			convert = self._compile_scalar_to_python(self.fsubtype, self.epoch)
+			return lambda value: {k:convert(v) for k,v in (value if isinstance(value, dict) else {str(value): value}).items()}
+		return self._compile_scalar_to_python(self.ftype, self.epoch)
+
+	def _compile_to_json(self):
+		if self.ftype is None:
+			return _identity
+		elif inspect.isclass(self.ftype) and issubclass(self.ftype, list):
+			convert = self._compile_scalar_to_json(self.fsubtype, self.epoch)
+			if convert is _identity:
+				return list
+			return lambda value: [convert(v) for v in value]
+		elif inspect.isclass(self.ftype) and issubclass(self.ftype, dict):
+			convert = self._compile_scalar_to_json(self.fsubtype, self.epoch)
+			if convert is _identity:
+				return dict
+			return lambda value: {k:convert(v) for k,v in value.items()}
+		return self._compile_scalar_to_json(self.ftype, self.epoch)
 
 	@classmethod
-	def _scalar_to_python(self, ftype, value):
-		# ftype and value must not be None
-		if inspect.isclass(ftype) and isinstance(value, ftype):
-			return value
+	def _compile_scalar_to_python(self, ftype, epoch=False):
+		# The returned function must not be passed None
+		if ftype is None:
+			return _identity
 		elif isinstance(ftype, Field):
-			return ftype._to_python(value)
+			return ftype._to_python
 		elif issubclass(ftype, Model):
-			return ftype(**value)
+			def model_to_python(value):
+				if isinstance(value, ftype):
+					return value
+				elif isinstance(value, dict) or ftype._schema.embedded:
+					return ftype(**value)
+				# A reference to a document stored elsewhere, kept as its id until read
+				return value
+			return model_to_python
 		elif issubclass(ftype, datetime):
-			out = parse(str(value))
-			if out.tzinfo is None or out.tzinfo.utcoffset(out) is None:
-				out = out.replace(tzinfo = pytz.timezone('UTC'))
-			return out
+			convert = _epoch_to_python if epoch else _datetime_to_python
+			return lambda value: value if isinstance(value, datetime) else convert(value)
 		else:
-			return ftype(value)
-
-	def _to_python(self, value_):
-		value = value_
-		if self.ftype is not None and value is not None:
-			if issubclass(self.ftype, list):
-				value = value if isinstance(value, list) else [value]
-				value = [self._scalar_to_python(self.fsubtype, v) for v in value]
-			elif issubclass(self.ftype, dict):
-				value = value if isinstance(value, dict) else {str(value): value}
-				value = {k:self._scalar_to_python(self.fsubtype, v) for k,v in value.items()}
-			else:
-				value = self._scalar_to_python(self.ftype, value)
-		return value
+			return lambda value: value if isinstance(value, ftype) else ftype(value)
 
 	@classmethod
-	def _scalar_to_json(self, ftype, value):
-		# ftype and value must not be None
-		if isinstance(ftype, Field):
-			return ftype._to_json(value)
+	def _compile_scalar_to_json(self, ftype, epoch=False):
+		# The returned function must not be passed None
+		if ftype is None:
+			return _identity
+		elif isinstance(ftype, Field):
+			return ftype._to_json
 		elif issubclass(ftype, Model):
-			if ftype._clsattr('__Embedded__'):
-				return value._to_json()
-			else:
-				return str(value._id)
+			def model_to_json(value):
+				if ftype._schema.embedded:
+					return value._to_json()
+				# A reference that has not been read yet is still its id
+				return str(value._id) if isinstance(value, Model) else value
+			return model_to_json
 		elif issubclass(ftype, datetime):
-			if value.tzinfo is None or value.tzinfo.utcoffset(value) is None:
-				value = value.replace(tzinfo = pytz.timezone('UTC'))
-			return value.isoformat()
+			return _epoch_to_json if epoch else _datetime_to_json
 		else:
-			return value
-
-	def _to_json(self, value_):
-		value = value_
-		if self.ftype is not None and value is not None:
-			if issubclass(self.ftype, list):
-				value = [self._scalar_to_json(self.fsubtype, v) for v in value]
-			elif issubclass(self.ftype, dict):
-				value = {k:self._scalar_to_json(self.fsubtype, v) for k,v in value.items()}
-			else:
-				value = self._scalar_to_json(self.ftype, value)
-		return value
+			return _identity
+
+	@classmethod
+	def _scalar_to_python(self, ftype, value):
+		# ftype and value must not be None
+		return self._compile_scalar_to_python(ftype)(value)
+
+	def _to_python(self, value):
+		if value is None:
+			return None
+		return self._python_converter(value)
+
+	@classmethod
+	def _scalar_to_json(self, ftype, value):
+		# ftype and value must not be None
+		return self._compile_scalar_to_json(ftype)(value)
+
+	def _to_json(self, value):
+		if value is None:
+			return None
+		return self._json_converter(value)
 
 	def validate(self, value_):
 		value = self._to_python(value_)
@@ -135,22 +212,76 @@ class Attachment(object):
 			out['stub'] = True
 		return out
 
+# Default values of these types are validated once, when the schema is compiled,
+# and then shared between instances
+_IMMUTABLE_TYPES = (type(None), bool, int, long, float, str, unicode, datetime)
+
+class ModelSchema(object):
+	"""\
+	The compiled form of a model's prototype: the field table, the resolved class
+	flags and the default value of every field.  Built once per class by
+	ModelMeta and treated as read-only afterwards; if a prototype is changed at
+	runtime, call Model._invalidate_schema() to rebuild it.
+	"""
+	def __init__(self, model):
+		attrs = {}
+		for source in (model.__DefaultPrototype__, model.__Prototype__):
+			for name in dir(source):
+				attrs[name] = getattr(source, name)
+		self.attrs = attrs
+		self.fields = {k:v for k,v in attrs.items() if isinstance(v, Field)}
+		self.strict = bool(attrs.get('__Strict__'))
+		self.embedded = bool(attrs.get('__Embedded__'))
+		self.database = attrs.get('__Database__')
+		self.type_name = attrs.get('__Type__') or attrs.get('__Collection__') or model.__name__
+
+		# name -> (True, validated value) for defaults that can be shared, or
+		# (False, raw default) for those that must be built for each instance
+		self.defaults = {}
+		for k, f in self.fields.items():
+			self.defaults[k] = (False, f.default)
+			if callable(f.default) or not isinstance(f.default, _IMMUTABLE_TYPES):
+				continue
+			try:
+				value = f.validate(f.default)
+			except Exception:
+				# Leave it to the instance, so the error is raised where it was before
+				continue
+			if isinstance(value, _IMMUTABLE_TYPES):
+				self.defaults[k] = (True, value)
+
+class ModelMeta(type):
+	def __init__(self, name, bases, attrs):
+		super(ModelMeta, self).__init__(name, bases, attrs)
+		self._schema = ModelSchema(self) if hasattr(self, '__Prototype__') else None
+
 class Model(object):
+	__metaclass__ = ModelMeta
+
 	class __DefaultPrototype__:
 		__Strict__=False	#If true, assignments to attributes not defined in __Prototype__ are an error
 		__Embedded__=False	#If true, this type of model only exists within other models
 
 	@classmethod
-	def _clsattr(self, attrName):
-		if hasattr(self, "__Prototype__"):
-			if hasattr(self.__Prototype__, attrName):
-				return getattr(self.__Prototype__, attrName)
-			elif hasattr(self.__DefaultPrototype__, attrName):
-				return getattr(self.__DefaultPrototype__, attrName)
-			else:
-				return None
-		else:
+	def _get_schema(self):
+		if self._schema is None:
 			raise ModelError("Model %s lacks a prototype"%(self.__name__,))
+		return self._schema
+
+	@classmethod
+	def _invalidate_schema(self):
+		"""\
+		Recompile the schema of this model and its subclasses.  Required after
+		modifying a prototype once the class has been created, for example:
+		SampleModel.__Prototype__.linkField = Field(SampleModel)
+		"""
+		self._schema = ModelSchema(self) if hasattr(self, '__Prototype__') else None
+		for subclass in self.__subclasses__():
+			subclass._invalidate_schema()
+
+	@classmethod
+	def _clsattr(self, attrName):
+		return self._get_schema().attrs.get(attrName)
 
 	@combomethod
 	def database(self):
@@ -158,33 +289,157 @@ class Model(object):
 			if hasattr(self, '_database'):
 				return database.DatabasePartial(self, self._database)
 		cls = self if inspect.isclass(self) and issubclass(self, Model) else self.__class__
-		db_string = cls._clsattr('__Database__')
+		db_string = cls._get_schema().database
 		if db_string is None:
 			raise ModelError("The prototype of class '%s' does not define __Database__" % (cls.__name__,))
 		return database.DatabasePartial(self, database.Database.get_instance(db_string))
 
 	@classmethod
 	def _fields(self):
-		if hasattr(self, "__Prototype__"):
-			return {k:v for k,v in self.__Prototype__.__dict__.items() if isinstance(v, Field)}
-		else:
-			raise ModelError("Model %s lacks a prototype"%(self.__name__,))
+		return self._get_schema().fields
 
 	@classmethod
 	def get_type_name(self):
-		return self._clsattr("__Type__") or self._clsattr("__Collection__") or self.__name__
+		return self._get_schema().type_name
+
+	@classmethod
+	def _field_subset(self, only=None, exclude=None):
+		"""\
+		The names of the fields loaded by a projection: the fields in only (plus _id,
+		if the model has it) or every field, less those in exclude.
+		"""
+		fields = self._get_schema().fields
+		names = set(fields) if only is None else set(only)
+		if only is not None and '_id' in fields:
+			names.add('_id')
+		names -= set(exclude or [])
+		unknown = (names | set(exclude or [])) - set(fields)
+		if unknown:
+			raise ModelError("Model %s has no fields %s" % (self.__name__, ', '.join(sorted(unknown))))
+		return names
 
 	def __init__(self, **kwargs):
-		self.__data__={}
-		try:
-			self.database().preprocess(kwargs)
-		except Exception as e:
-			log.error("Can't preprocess: %s: %s" % (e.__class__.__name__, str(e)))
-		for k,v in self.__class__._fields().items():
+		schema = self._get_schema()
+		self.__dict__['__data__']={}
+		self.__dict__['__raw__']=None
+		self.__dict__['__dirty__']=set()
+		self.__dict__['__loaded__']=None
+		self.__dict__['__shared__']=False
+		self._preprocess(kwargs)
+		for k,v in schema.fields.items():
 			if k in kwargs:
 				setattr(self, k, kwargs[k])
 			else:
-				setattr(self, k, v.default() if callable(v.default) else v.default)
+				shared, default = schema.defaults[k]
+				if shared:
+					self.__data__[k] = default
+				else:
+					setattr(self, k, default() if callable(default) else default)
+
+	@classmethod
+	def _load(self, data, fields=None, shared=False):
+		"""\
+		Trusted constructor for documents read from the database.  The raw document
+		is kept as-is and each field is converted the first time it is read, without
+		running its validation; fields that are never touched are serialized straight
+		from the raw document.
+
+		If fields is given, the document is the result of a projection: only those
+		fields are available and the others can be neither read nor saved.
+
+		The dicts and lists of the document are copied when their field is read, so
+		that changes made in place can be detected.  If shared is true, the document
+		is also held elsewhere (e.g. by a response cache) and must not be modified:
+		they are copied when serialized as well.
+		"""
+		instance = self.__new__(self)
+		instance.__dict__['__data__'] = {}
+		instance.__dict__['__raw__'] = data = dict(data)
+		instance.__dict__['__dirty__'] = set()
+		instance.__dict__['__loaded__'] = None if fields is None else set(fields)
+		instance.__dict__['__shared__'] = shared
+		instance._preprocess(data)
+		return instance
+
+	def _preprocess(self, data):
+		if self._get_schema().database is not None or hasattr(self.__class__, '_database'):
+			try:
+				self.database().preprocess(data)
+			except Exception as e:
+				log.error("Can't preprocess: %s: %s" % (e.__class__.__name__, str(e)))
+
+	def _hydrate(self, k, f):
+		loaded = self.__dict__['__loaded__']
+		if loaded is not None and k not in loaded:
+			raise ModelError("%s.%s was not loaded" % (self.__class__.__name__, k))
+		raw = self.__dict__['__raw__']
+		if raw is not None and k in raw:
+			value = raw[k]
+			if not isinstance(value, _IMMUTABLE_TYPES):
+				# The raw value is what changes are detected against, so the field must
+				# not share dicts or lists with it
+				value = _copy_json(value)
+			value = f._to_python(value)
+		else:
+			shared, value = self._get_schema().defaults[k]
+			if not shared:
+				value = f.validate(value() if callable(value) else value)
+		self.__dict__['__data__'][k] = value
+		return value
+
+	def _unresolved_reference(self, k):
+		"""\
+		The id held by reference field k if the referenced model has not been loaded
+		yet, otherwise None.
+		"""
+		data = self.__dict__['__data__']
+		value = data[k] if k in data else self._hydrate(k, self._get_schema().fields[k])
+		if value is None or isinstance(value, Model):
+			return None
+		return value
+
+	def _resolve_reference(self, k, instance):
+		self.__dict__['__data__'][k] = instance
+
+	def is_partial(self):
+		return self.__dict__['__loaded__'] is not None
+
+	def loaded_fields(self):
+		loaded = self.__dict__['__loaded__']
+		return set(self._get_schema().fields) if loaded is None else set(loaded)
+
+	def changed_fields(self):
+		"""\
+		Names of the fields that differ from what was last loaded or saved; every
+		field of an instance that has never been stored is considered changed.
+		"""
+		schema = self._get_schema()
+		raw = self.__dict__['__raw__']
+		if raw is None:
+			return set(schema.fields)
+		dirty = self.__dict__['__dirty__']
+		changed = set()
+		for k, v in self.__dict__['__data__'].items():
+			# Values that can be modified in place (embedded models, lists, ...) are
+			# compared even if they were never assigned to
+			if k in dirty or not isinstance(v, _IMMUTABLE_TYPES):
+				if schema.fields[k]._to_json(v) != raw.get(k):
+					changed.add(k)
+		return changed
+
+	def is_dirty(self):
+		return bool(self.changed_fields())
+
+	def _mark_clean(self, values):
+		"""\
+		Record that the serialized values given (a dict of field name to JSON value)
+		are now what the database holds.
+		"""
+		raw = dict(self.__dict__['__raw__'] or {})
+		# A copy, so that later changes made in place to the fields are not made to it too
+		raw.update(_copy_json(values))
+		self.__dict__['__raw__'] = raw
+		self.__dict__['__dirty__'].clear()
 
 	def touch(self):
 		"""\
@@ -194,13 +449,18 @@ class Model(object):
 		return True
 
 	def __setattr__(self, k, v):
-		if isinstance(self._clsattr(k), Field):
+		schema = self._get_schema()
+		f = schema.fields.get(k)
+		if f is not None:
 			try:
-				v=self._clsattr(k).validate(v)
+				v=f.validate(v)
 			except ValidationError as e:
 				raise ValidationError("%s.%s: %s"%(self.__class__.__name__, k, str(e)))
 			self.__dict__['__data__'][k]=v
-		elif (k in self.__dict__) or (not self._clsattr("__Strict__")):
+			self.__dict__['__dirty__'].add(k)
+			if self.__dict__['__loaded__'] is not None:
+				self.__dict__['__loaded__'].add(k)
+		elif (k in self.__dict__) or (not schema.strict):
 			self.__dict__[k]=v
 		else:
 			raise ValidationError("%s: No such attribute %s"%(self.__class__.__name__, k))
@@ -212,27 +472,38 @@ class Model(object):
 				return getattr(self.database(), k)(*args, **kwargs)
 			return wrapped_special_method
 
-		f=self.__class__._clsattr(k)
-		if isinstance(f, Field):
-			out=self.__dict__['__data__'][k]
-			if issubclass(f.ftype, Model) and not isinstance(out, f.ftype) and out is not None:
+		f=self._get_schema().fields.get(k)
+		if f is not None:
+			data=self.__dict__['__data__']
+			out=data[k] if k in data else self._hydrate(k, f)
+			if out is not None and inspect.isclass(f.ftype) and issubclass(f.ftype, Model) and not isinstance(out, f.ftype):
 				#Requested field should be a model instance, but it is not - load it
-				if f.ftype._clsattr("__Embedded__"):
+				if f.ftype._get_schema().embedded:
 					out=f.ftype(**out)
 				else:
-					#A load from the database is required.
-					pass #TODO: load from the database
-				setattr(self, k, out)
+					out=f.ftype.database()._get_reference(out)
+				# Loading does not change the stored value, so the field is not marked dirty
+				data[k]=out
 			return out
 		else:
 			return self.__dict__[k]
 
 	def _to_json(self, skip=None, extra = {}):
 		out={}
-		for k,v in self.__dict__['__data__'].items():
-			if skip and k in skip:
+		data = self.__dict__['__data__']
+		raw = self.__dict__['__raw__']
+		loaded = self.__dict__['__loaded__']
+		for k,f in self._get_schema().fields.items():
+			if (skip and k in skip) or (loaded is not None and k not in loaded):
 				continue
-			out[k] = self._clsattr(k)._to_json(v)
+			if k in data:
+				out[k] = f._to_json(data[k])
+			elif raw is not None and k in raw:
+				out[k] = raw[k]
+				if self.__dict__['__shared__'] and not isinstance(out[k], _IMMUTABLE_TYPES):
+					out[k] = _copy_json(out[k])
+			else:
+				out[k] = f._to_json(self._hydrate(k, f))
 		out.update(extra)
 		return out
 
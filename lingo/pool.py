@@ -0,0 +1,157 @@
+import time
+import select
+import socket
+import httplib
+import threading
+from collections import deque
+
+from errors import *
+
+def _is_dropped(conn):
+	"""\
+	Whether an idle keep-alive connection can no longer be used: nothing should be
+	readable on it between requests, so a readable socket means the server closed it
+	(or sent something unexpected).
+	"""
+	if conn.sock is None:
+		return True
+	try:
+		readable, _, _ = select.select([conn.sock], [], [], 0)
+	except (select.error, socket.error, ValueError):
+		return True
+	return bool(readable)
+
+class ConnectionPool(object):
+	"""\
+	A bounded pool of keep-alive HTTP connections to one server, shared by all threads.
+
+	Connections are checked out with get() and returned with put(); a checked out
+	connection belongs to one thread until it is returned, and must be returned with
+	discard = True if it was left in an unknown state (an error, or a response that was
+	not read to the end).  When all maxsize connections are checked out, get() waits for
+	one to be returned (up to timeout seconds, or forever if timeout is None), or raises
+	PoolExhaustedError straight away if the pool does not block.  Idle connections are
+	closed after idle_timeout seconds, and checked before being handed out again.
+	"""
+	def __init__(self, host, port, maxsize = 10, block = True, timeout = None, idle_timeout = 60, connect_timeout = None):
+		if maxsize < 1:
+			raise ValueError("A connection pool needs at least one connection")
+		self.host = host
+		self.port = port
+		self.maxsize = maxsize
+		self.block = block
+		self.timeout = timeout
+		self.idle_timeout = idle_timeout
+		self.connect_timeout = connect_timeout
+
+		self._lock = threading.Condition(threading.Lock())
+		self._idle = deque()  # (connection, returned at), most recently returned last
+		self._size = 0  # connections open or being opened, idle or not
+		self._counters = dict(created = 0, reused = 0, discarded = 0, expired = 0, dropped = 0, waited = 0, exhausted = 0)
+
+	def _connect(self):
+		if self.connect_timeout is None:
+			conn = httplib.HTTPConnection(self.host, self.port)
+		else:
+			conn = httplib.HTTPConnection(self.host, self.port, timeout = self.connect_timeout)
+		conn.connect()
+		return conn
+
+	def _close(self, conn):
+		try:
+			conn.close()
+		except (socket.error, httplib.HTTPException):
+			pass
+
+	def get(self, block = None, timeout = None):
+		"""Check out a connection, reusing an idle one if there is one"""
+		block = self.block if block is None else block
+		timeout = self.timeout if timeout is None else timeout
+		deadline = None if timeout is None else time.time() + timeout
+		with self._lock:
+			while True:
+				while self._idle:
+					# Most recently used first, so that the rest can expire
+					conn, returned = self._idle.pop()
+					if self.idle_timeout is not None and time.time() - returned > self.idle_timeout:
+						self._counters['expired'] += 1
+					elif _is_dropped(conn):
+						self._counters['dropped'] += 1
+					else:
+						self._counters['reused'] += 1
+						return conn
+					self._size -= 1
+					self._close(conn)
+				if self._size < self.maxsize:
+					self._size += 1
+					break
+				if not block:
+					self._counters['exhausted'] += 1
+					raise PoolExhaustedError("All %d connections to %s:%s are in use" % (self.maxsize, self.host, self.port))
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					self._counters['exhausted'] += 1
+					raise PoolExhaustedError("Timed out waiting for one of %d connections to %s:%s" % (self.maxsize, self.host, self.port))
+				self._counters['waited'] += 1
+				self._lock.wait(remaining)
+
+		# Connect outside of the lock, so that other threads can use idle connections meanwhile
+		try:
+			conn = self._connect()
+		except:
+			with self._lock:
+				self._size -= 1
+				self._lock.notify()
+			raise
+		with self._lock:
+			self._counters['created'] += 1
+		return conn
+
+	def put(self, conn, discard = False):
+		"""Return a checked out connection; discarded connections are closed and make room for a new one"""
+		if not discard and conn.sock is None:
+			# The server asked for the connection to be closed after the last response
+			discard = True
+		with self._lock:
+			if discard:
+				self._size -= 1
+				self._counters['discarded'] += 1
+			else:
+				self._idle.append((conn, time.time()))
+			self._lock.notify()
+		if discard:
+			self._close(conn)
+
+	def warm(self, count = 1):
+		"""Open up to count connections ahead of time, so that the first requests do not wait for them"""
+		conns = []
+		try:
+			for _ in range(min(count, self.maxsize)):
+				conns.append(self.get(block = False))
+		except PoolExhaustedError:
+			pass
+		finally:
+			for conn in conns:
+				self.put(conn)
+		return len(conns)
+
+	def clear(self):
+		"""Close every idle connection; checked out connections are closed when returned with discard = True"""
+		with self._lock:
+			idle = list(self._idle)
+			self._idle.clear()
+			self._size -= len(idle)
+			self._lock.notify_all()
+		for conn, returned in idle:
+			self._close(conn)
+
+	def stats(self):
+		with self._lock:
+			out = dict(self._counters)
+			out.update(
+				maxsize = self.maxsize,
+				size = self._size,
+				idle = len(self._idle),
+				in_use = self._size - len(self._idle)
+			)
+			return out
@@ -1,5 +1,10 @@
 import time
+import json
+import zlib
+import threading
 import logging
+import BaseHTTPServer
+import SocketServer
 from StringIO import StringIO
 logging.basicConfig()
 
@@ -29,9 +34,42 @@ class SampleModel(lingo.Model):
 						}
 					}
 				"""
+			},
+			'summaryByStrField': {
+				'map': """\
+					function(doc) {
+						if (doc.type == "SampleModel") {
+							emit(doc.strField, {strField: doc.strField});
+						}
+					}
+				"""
+			},
+			'sumByStrField': {
+				'map': """\
+					function(doc) {
+						if (doc.type == "SampleModel") {
+							emit([doc.strField, doc.embedField.intField], doc.embedField.intField);
+						}
+					}
+				""",
+				'reduce': '_sum'
+			},
+			'countByStrField': {
+				'map': """\
+					function(doc) {
+						if (doc.type == "SampleModel") {
+							emit(doc.strField, null);
+						}
+					}
+				""",
+				'reduce': '_count'
 			}
 		}
 
+		__Indexes__ = {
+			'byStrField': ['strField']
+		}
+
 class SampleModel2(lingo.Model):
 	class __Prototype__:
 		__Database__ = 'CouchDB'
@@ -50,7 +88,12 @@ class SampleModel2(lingo.Model):
 			}
 		}
 
+class SampleSubModel2(SampleModel2):
+	# Not a direct subclass of lingo.Model, its views are synced all the same
+	pass
+
 SampleModel.__Prototype__.linkField=lingo.Field(SampleModel, default=None)
+SampleModel._invalidate_schema()
 
 class TouchableModel(lingo.Model):
 	class __Prototype__:
@@ -62,6 +105,25 @@ class TouchableModel(lingo.Model):
 		self.strField = u'touched'
 		return True
 
+class AsyncSampleModel(lingo.Model):
+	class __Prototype__:
+		__Database__ = 'AsyncCouchDB'
+		_id=lingo.Field(unicode)
+		_rev=lingo.Field(unicode)
+		strField=lingo.Field(unicode, default=u"")
+
+		__Views__ = {
+			'getByStrField': {
+				'map': """\
+					function(doc) {
+						if (doc.type == "AsyncSampleModel") {
+							emit(doc.strField, doc.id);
+						}
+					}
+				"""
+			}
+		}
+
 class TestCouchDB(unittest.TestCase):
 	def setUp(self):
 		try:
@@ -82,6 +144,11 @@ class TestCouchDB(unittest.TestCase):
 		self.db.create_db('lingo-test')
 		self.db.sync_views()
 
+	def _syncIndexes(self):
+		if not self.db.has_mango():
+			self.skipTest("CouchDB %s does not support Mango" % (self.db.server_version,))
+		return self.db.sync_indexes()
+
 	def test_Authentication(self):
 		self.db.create_admin('adminuser', 'password')
 		try:
@@ -111,6 +178,33 @@ class TestCouchDB(unittest.TestCase):
 		self.assertGreater(len(i._id), 0)
 		self.assertGreater(len(i._rev), 0)
 
+	def test_AssignId(self):
+		linked = SampleModel(strField = "linked")
+		_id = linked.database().assign_id()
+		self.assertEquals(_id, linked._id)
+		i = SampleModel(linkField = linked)
+		i.database().save()
+		linked.database().save()
+		self.assertEquals(_id, linked._id)
+		self.assertEquals(_id, SampleModel.database().get(i._id).linkField._id)
+
+	def test_SaveNewWithTakenId(self):
+		i = SampleModel(strField = "foo")
+		i.database().assign_id()
+		self.db.save(SampleModel(_id = i._id, strField = "first"))
+		with self.assertRaises(lingo.DatabaseError):
+			i.database().save()
+		self.assertEquals(u"first", SampleModel.database().get(i._id).strField)
+
+	def test_TimeOrderedIds(self):
+		self.db.id_generator = database.time_ordered_id
+		objs = [SampleModel(strField = "Test %d" % (i,)) for i in range(0, 5)]
+		for obj in objs:
+			obj.database().save()
+		self.assertEquals(sorted(obj._id for obj in objs), [obj._id for obj in objs])
+		res = SampleModel.database().save_many([SampleModel(strField = "bulk")])
+		self.assertGreater(res[0].id, objs[-1]._id)
+
 	def test_Touch(self):
 		i=TouchableModel()
 		self.assertEquals(i.strField, u'')
@@ -180,6 +274,115 @@ class TestCouchDB(unittest.TestCase):
 		for obj in res:
 			self.assertTrue(obj.strField in ['foo', 'bar'])
 
+	def test_GetReference(self):
+		target=SampleModel(strField="target")
+		target.database().save()
+		i=SampleModel(strField="source", linkField=target)
+		i.database().save()
+		i=SampleModel.database().get(i._id)
+		self.assertEquals(u"target", i.linkField.strField)
+		self.assertEquals(target._id, i.linkField._id)
+
+	def test_FindPrefetch(self):
+		target=SampleModel(strField="target")
+		target.database().save()
+		for v in ["foo", "foo"]:
+			SampleModel(strField=v, linkField=target).database().save()
+
+		res = SampleModel.database().find('getByStrField', 'foo').prefetch('linkField')
+		self.assertEquals(2, len(res))
+		self.assertIs(res[0].linkField, res[1].linkField)
+		self.assertEquals(u"target", res[0].linkField.strField)
+
+	def test_SessionIdentityMap(self):
+		i=SampleModel(strField="foobar")
+		i.database().save()
+		with self.db.session():
+			a=SampleModel.database().get(i._id)
+			self.assertIs(a, SampleModel.database().get(i._id))
+			self.assertIs(a, SampleModel.database().find('getByStrField', 'foobar')[0])
+			a.strField="barbaz"
+			a.database().save()
+			self.assertIs(a, SampleModel.database().get(i._id))
+			a.database().delete()
+			with self.assertRaises(errors.NotFoundError):
+				SampleModel.database().get(i._id)
+
+	def test_FindOnly(self):
+		i=SampleModel(strField="foo")
+		i.database().save()
+		res = SampleModel.database().find('summaryByStrField', 'foo').only('strField')
+		self.assertEquals(1, len(res))
+		self.assertTrue(res[0].is_partial())
+		self.assertEquals(i._id, res[0]._id)
+		self.assertEquals(u"foo", res[0].strField)
+		with self.assertRaises(lingo.ModelError):
+			res[0].embedField
+		with self.assertRaises(lingo.ModelError):
+			res[0].database().save()
+
+	def test_FindOnlyWithoutObjectValues(self):
+		SampleModel(strField="foo").database().save()
+		with self.assertRaises(lingo.DatabaseError):
+			len(SampleModel.database().find('getByStrField', 'foo').only('strField'))
+
+	def test_SaveMany(self):
+		objs=[SampleModel(strField="Test %d" % (i,)) for i in range(0, 25)]
+		objs[0].attach('test.txt', data = "hello world")
+		res=SampleModel.database().save_many(objs, batch_size = 10)
+		self.assertEquals(25, len(res))
+		for obj, r in zip(objs, res):
+			self.assertIs(obj, r.instance)
+			self.assertIsNone(r.error)
+			self.assertEquals(obj._id, r.id)
+			self.assertEquals(obj._rev, r.rev)
+			self.assertFalse(obj.is_dirty())
+		self.assertEquals(25, len(SampleModel.database().find('getByStrField')))
+		self.assertEquals("hello world", SampleModel.database().get(objs[0]._id).get_attachment('test.txt'))
+
+	def test_SaveManyWithoutRevField(self):
+		objs=[TouchableModel() for i in range(0, 3)]
+		res=TouchableModel.database().save_many(objs)
+		self.assertEquals([None] * 3, [r.error for r in res])
+		self.assertTrue(all(r.rev for r in res))
+		self.assertEquals([u'touched'] * 3, [obj.strField for obj in objs])
+		self.assertEquals(u'touched', TouchableModel.database().get(objs[0]._id).strField)
+
+	def test_SaveManyConflict(self):
+		i=SampleModel(strField="foo")
+		i.database().save()
+		stale=SampleModel.database().get(i._id)
+		i.strField="bar"
+		i.database().save()
+		stale.strField="baz"
+		res=SampleModel.database().save_many([stale, SampleModel(strField="new")])
+		self.assertEquals('conflict', res[0].error)
+		self.assertIsNone(res[1].error)
+		self.assertEquals(u"bar", SampleModel.database().get(i._id).strField)
+
+	def test_DeleteMany(self):
+		objs=[SampleModel(strField="foo") for i in range(0, 5)]
+		SampleModel.database().save_many(objs)
+		res=SampleModel.database().delete_many(objs + [SampleModel()], batch_size = 2)
+		self.assertEquals(6, len(res))
+		self.assertTrue(all(r.error is None for r in res))
+		self.assertEquals(0, len(SampleModel.database().find('getByStrField')))
+
+	def test_GetMany(self):
+		objs=[SampleModel(strField="Test %d" % (i,)) for i in range(0, 5)]
+		SampleModel.database().save_many(objs)
+		objs[1].database().delete()
+		ids=[objs[3]._id, "thisiddoesnotexistever", objs[1]._id, objs[0]._id, objs[3]._id]
+		res=SampleModel.database().get_many(ids, chunk_size = 2)
+		self.assertEquals(5, len(res))
+		self.assertEquals(u"Test 3", res[0].strField)
+		self.assertIsNone(res[1])
+		self.assertIsNone(res[2])
+		self.assertEquals(u"Test 0", res[3].strField)
+		self.assertIs(res[0], res[4])
+		self.assertEquals(["thisiddoesnotexistever"], res.missing)
+		self.assertEquals([objs[1]._id], res.deleted)
+
 	def test_FindMissing(self):
 		res = SampleModel.database().find('getByStrField', 'notarealkey')
 		self.assertEquals(0, len(res))
@@ -206,6 +409,20 @@ class TestCouchDB(unittest.TestCase):
 		self.assertEquals(tempid, i._id)
 		self.assertEquals(i.strField, u"foobar")
 
+	def test_SaveClean(self):
+		i=SampleModel(strField="foobar")
+		i.database().save()
+		rev=i._rev
+		self.assertFalse(i.is_dirty())
+		i.database().save()
+		self.assertEquals(rev, i._rev)
+		i=SampleModel.database().get(i._id)
+		i.database().save()
+		self.assertEquals(rev, i._rev)
+		i.strField="barbaz"
+		i.database().save()
+		self.assertNotEquals(rev, i._rev)
+
 	def test_SaveExisting(self):
 		i=SampleModel(strField="foobar")
 		i.database().save()
@@ -273,6 +490,304 @@ class TestCouchDB(unittest.TestCase):
 			for obj in res:
 				self.assertTrue(obj.strField in fields)
 
+	def test_PaginationByKey(self):
+		ids = set()
+		for i in range(0, 50):
+			# Repeated keys, so that pages have to be split by document id too
+			v = SampleModel(strField = "Test %d" % (i % 10,))
+			self.db.save(v)
+			ids.add(v._id)
+
+		res = SampleModel.database().find('getByStrField', use_startkey = True, limit = 7)
+		seen = []
+		pages = 0
+		while True:
+			pages += 1
+			seen.extend(obj._id for obj in res)
+			if res.next_page() is None:
+				break
+		self.assertEquals(8, pages)
+		self.assertEquals(50, len(seen))
+		self.assertEquals(ids, set(seen))
+		with self.assertRaises(lingo.DatabaseError):
+			res.page(3)
+
+	def test_PaginationByKeyToken(self):
+		for i in range(0, 10):
+			self.db.save(SampleModel(strField = "Test %d" % (i,)))
+
+		res = SampleModel.database().find('getByStrField', use_startkey = True, limit = 4)
+		self.assertEquals([u"Test 0", u"Test 1", u"Test 2", u"Test 3"], [obj.strField for obj in res])
+		token = res.next_page_token
+		self.assertIsNotNone(token)
+
+		resumed = SampleModel.database().find('getByStrField', use_startkey = True, limit = 4).page_token(token)
+		self.assertEquals([u"Test 4", u"Test 5", u"Test 6", u"Test 7"], [obj.strField for obj in resumed])
+		resumed.next_page()
+		self.assertEquals([u"Test 8", u"Test 9"], [obj.strField for obj in resumed])
+		self.assertIsNone(resumed.next_page_token)
+		self.assertIsNone(resumed.next_page())
+
+		with self.assertRaises(lingo.DatabaseError):
+			resumed.page_token("garbage")
+		with self.assertRaises(lingo.DatabaseError):
+			SampleModel.database().find('getByStrField', limit = 4).page_token(token)
+
+	def test_FindRange(self):
+		for i in range(0, 10):
+			self.db.save(SampleModel(strField = "Test %d" % (i,)))
+
+		res = SampleModel.database().find('getByStrField', startkey = "Test 3", endkey = "Test 6")
+		self.assertEquals([u"Test 3", u"Test 4", u"Test 5", u"Test 6"], [obj.strField for obj in res])
+		res = SampleModel.database().find('getByStrField', startkey = "Test 6", endkey = "Test 3", descending = True)
+		self.assertEquals([u"Test 6", u"Test 5", u"Test 4", u"Test 3"], [obj.strField for obj in res])
+		with self.assertRaises(lingo.DatabaseError):
+			SampleModel.database().find('getByStrField', "Test 3", use_startkey = True)
+
+	def test_Stream(self):
+		ids = set()
+		for i in range(0, 30):
+			v = SampleModel(strField = "Test %d" % (i % 10,))
+			self.db.save(v)
+			ids.add(v._id)
+
+		res = SampleModel.database().find('getByStrField')
+		streamed = list(res.stream(batch_size = 7))
+		self.assertEquals(ids, set(obj._id for obj in streamed))
+		self.assertTrue(all(isinstance(obj, SampleModel) for obj in streamed))
+		self.assertIsNone(res._data)
+
+		by_key = list(SampleModel.database().find('getByStrField').stream(batch_size = 7, page_size = 4))
+		self.assertEquals([obj._id for obj in streamed], [obj._id for obj in by_key])
+
+		rows = list(SampleModel.database().find('getByStrField', limit = 5).iter_rows())
+		self.assertEquals(5, len(rows))
+		self.assertEquals(u"Test 0", rows[0]['key'])
+
+	def test_StreamOnly(self):
+		SampleModel(strField = "foo").database().save()
+		res = list(SampleModel.database().find('summaryByStrField', 'foo').only('strField').stream())
+		self.assertEquals(1, len(res))
+		self.assertTrue(res[0].is_partial())
+		self.assertEquals(u"foo", res[0].strField)
+
+	def test_Changes(self):
+		obj = SampleModel(strField = "foo")
+		self.db.save(obj)
+		other = SampleModel2(strField = "bar")
+		self.db.save(other)
+		feed = self.db.changes(since = 0)
+		changes = [c for c in feed if not c.id.startswith('_design/')]
+		self.assertEquals([obj._id, other._id], [c.id for c in changes])
+		self.assertIsInstance(changes[0].instance, SampleModel)
+		self.assertEquals(u"foo", changes[0].instance.strField)
+		self.assertEquals(obj._rev, changes[0].rev)
+
+		changes = list(SampleModel.database().changes(since = 0))
+		self.assertEquals([obj._id], [c.id for c in changes])
+
+		since = feed.last_seq
+		self.db.delete(obj)
+		changes = list(SampleModel.database().changes(since = since))
+		self.assertEquals(1, len(changes))
+		self.assertTrue(changes[0].deleted)
+		self.assertIsNone(changes[0].instance)
+
+		with self.assertRaises(lingo.DatabaseError):
+			self.db.changes(types = [SampleModel], include_docs = False)
+
+	def test_ChangesContinuous(self):
+		since = self.db._request_db('GET', '').parsed_body['update_seq']
+		obj = SampleModel(strField = "foo")
+		self.db.save(obj)
+		feed = SampleModel.database().changes(since = since, feed = 'continuous', heartbeat = 100)
+		for change in feed:
+			self.assertEquals(obj._id, change.id)
+			feed.stop()
+		self.assertEquals(change.seq, feed.last_seq)
+
+	def test_FollowChanges(self):
+		seen = []
+		received = threading.Event()
+		def callback(change):
+			seen.append(change)
+			received.set()
+		consumer = SampleModel.database().follow_changes(callback, heartbeat = 100)
+		try:
+			time.sleep(0.2)
+			obj = SampleModel(strField = "foo")
+			self.db.save(obj)
+			self.db.save(SampleModel2(strField = "bar"))
+			self.assertTrue(received.wait(5))
+			self.assertEquals(obj._id, seen[0].instance._id)
+		finally:
+			consumer.stop(5)
+		self.assertFalse(consumer.is_alive())
+		# The change of the SampleModel2 is filtered out, but moves last_seq past it if it was read
+		self.assertIn(consumer.last_seq, (seen[-1].seq, self.db._request_db('GET', '').parsed_body['update_seq']))
+
+	def test_SyncViewsUnchanged(self):
+		before = self.db.get(None, '_design/SampleModel')
+		self.assertEquals([], self.db.sync_views())
+		self.assertEquals(before['_rev'], self.db.get(None, '_design/SampleModel')['_rev'])
+		self.assertIn('getAll', self.db.get(None, '_design/SampleSubModel2')['views'])
+
+	def test_SyncViewsChanged(self):
+		doc = self.db.get(None, '_design/SampleModel')
+		doc['views'] = {'getAll': {'map': 'function(doc) {}'}}
+		doc['filters'] = {'byType': 'function(doc, req) { return true; }'}
+		del doc['lingo_hash']
+		self.db._request_db('PUT', '/_design/SampleModel', {}, json.dumps(doc), {'Content-type': 'application/json'})
+		self.assertEquals(['_design/SampleModel'], self.db.sync_views(warm = True))
+		doc = self.db.get(None, '_design/SampleModel')
+		self.assertEquals(set(['getByStrField', 'summaryByStrField', 'sumByStrField', 'countByStrField']), set(doc['views']))
+		self.assertIn('byType', doc['filters'])
+		self.assertEquals([], self.db.sync_views())
+
+	def test_ResponseCache(self):
+		database.Database.instances = {}
+		self.db = database.CouchDB('http://localhost', 'lingo-test', sync_views = False, response_cache = 10)
+		events = []
+		self.db.add_hook(events.append)
+		i = SampleModel(strField = "foo")
+		self.db.save(i)
+		# The save decodes its response too
+		del events[:]
+
+		first = SampleModel.database().get(i._id)
+		second = SampleModel.database().get(i._id)
+		self.assertIsNot(first, second)
+		self.assertEquals(u"foo", second.strField)
+		self.assertEquals(2, len([e for e in events if e.operation == 'GET' and e.target == '/{db}/{id}']))
+		self.assertEquals(1, len([e for e in events if e.operation == 'decode' and e.target == '/{db}/{id}']))
+		second._asdict()['embedField']['intField'] = 5
+		self.assertEquals(0, SampleModel.database().get(i._id).embedField.intField)
+
+		i.strField = u"bar"
+		self.db.save(i)
+		self.assertEquals(u"bar", SampleModel.database().get(i._id).strField)
+
+		doc = self.db.get(None, i._id)
+		doc['strField'] = u"baz"
+		self.assertEquals(u"bar", self.db.get(None, i._id)['strField'])
+
+		self.assertEquals(1, len(SampleModel.database().find('getByStrField', limit = 5)))
+		self.assertEquals(1, len(SampleModel.database().find('getByStrField', limit = 5)))
+		self.assertEquals(1, len([e for e in events if e.operation == 'decode' and '_view' in e.target]))
+
+	def test_FindReduce(self):
+		for strField, intField in [("a", 1), ("a", 2), ("b", 3), ("b", 3)]:
+			self.db.save(SampleModel(strField = strField, embedField = SampleEmbeddedModel(intField = intField)))
+
+		res = SampleModel.database().find('sumByStrField')
+		self.assertEquals(4, len(res))
+		self.assertTrue(all(isinstance(obj, SampleModel) for obj in res))
+
+		self.assertEquals([database.ViewRow(None, 9, None)], list(SampleModel.database().find('sumByStrField').reduce()))
+		self.assertEquals([(["a"], 3), (["b"], 6)], [(row.key, row.value) for row in SampleModel.database().find('sumByStrField').group_level(1)])
+		self.assertEquals([(["a", 1], 1), (["a", 2], 2), (["b", 3], 6)], [(row.key, row.value) for row in SampleModel.database().find('sumByStrField').group()])
+
+		rows = list(SampleModel.database().find('sumByStrField').rows())
+		self.assertEquals(4, len(rows))
+		self.assertEquals(["a", 1], rows[0].key)
+		self.assertIsNotNone(rows[0].id)
+
+	def test_FindOptions(self):
+		for i in range(0, 5):
+			self.db.save(SampleModel(strField = "Test %d" % (i,)))
+		# Build the index, stale reads do not
+		self.assertEquals(5, len(SampleModel.database().find('getByStrField')))
+		res = SampleModel.database().find('getByStrField', startkey = "Test 1", endkey = "Test 3").inclusive_end(False).stale('ok')
+		self.assertEquals([u"Test 1", u"Test 2"], [obj.strField for obj in res])
+		with self.assertRaises(lingo.DatabaseError):
+			res.stale('sometimes')
+
+	def test_Count(self):
+		for i in range(0, 10):
+			self.db.save(SampleModel(strField = "Test %d" % (i % 4,)))
+		events = []
+		self.db.add_hook(events.append)
+
+		self.assertEquals(10, SampleModel.database().find('getByStrField').count())
+		self.assertEquals(3, SampleModel.database().find('getByStrField', "Test 1").count())
+		self.assertEquals(4, SampleModel.database().find('getByStrField', startkey = "Test 2").count())
+		self.assertEquals(10, SampleModel.database().find('countByStrField').count())
+		self.assertEquals(6, SampleModel.database().find('countByStrField', ["Test 0", "Test 1"]).count())
+		self.assertEquals(3, SampleModel.database().find('countByStrField', endkey = "Test 0").count())
+		self.assertEquals(4, SampleModel.database().find('sumByStrField').group_level(1).count())
+		self.assertEquals(0, len([e for e in events if e.operation == 'hydrate']))
+
+		res = SampleModel.database().find('getByStrField', "Test 1", limit = 2)
+		self.assertEquals(2, res.pages())
+		self.assertEquals(0, len([e for e in events if e.operation == 'hydrate']))
+
+		res = SampleModel.database().find('getByStrField', limit = 3)
+		self.assertEquals(3, len(res))
+		del events[:]
+		self.assertEquals(4, res.pages())
+		self.assertEquals([], events)
+
+	def test_FindSelector(self):
+		self._syncIndexes()
+		for i in range(0, 5):
+			self.db.save(SampleModel(strField = "Test %d" % (i,)))
+		self.db.save(SampleModel2(strField = "Test 1"))
+		res = SampleModel.database().find({'strField': {'$gte': "Test 1"}}, sort = ['strField'], limit = 2)
+		self.assertEquals([u"Test 1", u"Test 2"], [obj.strField for obj in res])
+		self.assertTrue(all(isinstance(obj, SampleModel) for obj in res))
+		self.assertIs(res, res.next_page())
+		self.assertEquals([u"Test 3", u"Test 4"], [obj.strField for obj in res])
+		token = res.next_page_token
+		res = SampleModel.database().find({'strField': {'$gte': "Test 1"}}, sort = ['strField'], limit = 2).page_token(token)
+		self.assertEquals([], list(res))
+		self.assertIsNone(res.next_page())
+		self.assertEquals('byStrField', SampleModel.database().find({'strField': "Test 1"}).explain()['index']['name'])
+
+	def test_FindSelectorOnly(self):
+		self._syncIndexes()
+		self.db.save(SampleModel(strField = "Test"))
+		obj = SampleModel.database().find({'strField': "Test"}, fields = ['strField'])[0]
+		self.assertTrue(obj.is_partial())
+		self.assertEquals(u"Test", obj.strField)
+		self.assertIsNotNone(obj._id)
+		with self.assertRaises(lingo.ModelError):
+			obj.embedField
+
+	def test_SyncIndexes(self):
+		self.assertEquals(['_design/lingo-SampleModel-byStrField'], self._syncIndexes())
+		self.assertEquals([], self.db.sync_indexes())
+		self.db._request_db('DELETE', '/_index/lingo-SampleModel-byStrField/json/byStrField')
+		self.db._request_db('POST', '/_index', None, json.dumps({'index': {'fields': ['strField']}, 'ddoc': 'lingo-SampleModel-byStrField', 'name': 'byStrField'}), {'Content-type': 'application/json'})
+		self.assertEquals(['_design/lingo-SampleModel-byStrField'], self.db.sync_indexes())
+		self.assertEquals([], self.db.sync_indexes())
+
+	def test_Gather(self):
+		objs = [SampleModel(strField = "Test %d" % (i % 2,)) for i in range(0, 4)]
+		self.db.save_many(SampleModel, objs)
+		first, second, obj, missing = self.db.gather(
+			SampleModel.database().find('getByStrField', "Test 0"),
+			SampleModel.database().find('getByStrField', "Test 1"),
+			lambda: SampleModel.database().get(objs[0]._id),
+			lambda: SampleModel.database().get('missing'))
+		self.assertEquals([u"Test 0"] * 2, [i.strField for i in first])
+		self.assertEquals([u"Test 1"] * 2, [i.strField for i in second])
+		self.assertEquals(objs[0]._id, obj._id)
+		self.assertIsInstance(missing, errors.NotFoundError)
+		with self.assertRaises(errors.NotFoundError):
+			self.db.gather(lambda: SampleModel.database().get('missing'), raise_errors = True)
+		self.db.close()
+
+	def test_Compression(self):
+		database.Database.instances = {}
+		self.db = database.CouchDB('http://localhost', 'lingo-test', sync_views = False, compression = True, compress_min_size = 100)
+		objs = [SampleModel(strField = "Test %d " % (i,) * 50) for i in range(0, 20)]
+		SampleModel.database().save_many(objs)
+		objs[0].strField += u"changed " * 50
+		objs[0].database().save()
+		self.assertEquals(objs[0].strField, SampleModel.database().get(objs[0]._id).strField)
+		self.assertEquals(20, len(SampleModel.database().find('getByStrField')))
+		self.assertEquals(20, len(list(SampleModel.database().find('getByStrField').stream())))
+
 	def test_SaveAndGetAttachment_String(self):
 		i=SampleModel(strField="foobar")
 		i.attach('test.txt', data = "hello world")
@@ -351,5 +866,206 @@ class TestCouchDB(unittest.TestCase):
 		i=SampleModel.database().get(tempid)
 		self.assertEquals("\x89PNG\r\nhello world", i.get_attachment('test.png'))
 
+class TestAsyncCouchDB(unittest.TestCase):
+	def setUp(self):
+		database.Database.instances = {}
+		db = database.CouchDB('http://localhost', 'lingo-test', sync_views = False)
+		try:
+			db.delete_db('lingo-test')
+		except:
+			pass
+		db.create_db('lingo-test')
+		self.db = database.AsyncCouchDB('http://localhost', 'lingo-test', workers = 4)
+
+	def tearDown(self):
+		self.db.close()
+
+	def test_SaveAndGet(self):
+		objs = [AsyncSampleModel(strField = "Test %d" % (i,)) for i in range(0, 10)]
+		pending = [obj.database().save() for obj in objs]
+		ids = [p.get(5) for p in pending]
+		self.assertTrue(all(ids))
+		pending = [AsyncSampleModel.database().get(_id) for _id in ids]
+		self.assertEquals([obj.strField for obj in objs], [p.get(5).strField for p in pending])
+		self.assertEquals(ids, [obj._id for obj in AsyncSampleModel.database().get_many(ids).get(5)])
+
+	def test_GetMissing(self):
+		with self.assertRaises(errors.NotFoundError):
+			AsyncSampleModel.database().get('missing').get(5)
+
+	def test_Find(self):
+		for i in range(0, 3):
+			AsyncSampleModel(strField = "Test %d" % (i,)).database().save().get(5)
+		res = AsyncSampleModel.database().find('getByStrField')
+		self.assertIs(res, res.fetch_async().get(5))
+		self.assertEquals([u"Test 0", u"Test 1", u"Test 2"], [obj.strField for obj in res])
+		self.assertEquals(1, len(AsyncSampleModel.database().find('getByStrField', 'Test 1')))
+
+	def test_FindSelector(self):
+		if not self.db.has_mango():
+			self.skipTest("CouchDB %s does not support Mango" % (self.db.server_version,))
+		AsyncSampleModel(strField = "Test").database().save().get(5)
+		res = AsyncSampleModel.database().find({'strField': "Test"})
+		self.assertIs(res, res.fetch_async().get(5))
+		self.assertEquals([u"Test"], [obj.strField for obj in res])
+
+	def test_Gather(self):
+		obj = AsyncSampleModel(strField = "Test")
+		obj.database().save().get(5)
+		res, got = self.db.gather(AsyncSampleModel.database().find('getByStrField'), lambda: AsyncSampleModel.database().get(obj._id))
+		self.assertEquals([u"Test"], [i.strField for i in res])
+		self.assertEquals(u"Test", got.strField)
+
+class TestViewRowsParser(unittest.TestCase):
+	BODY = '{"total_rows":3,"offset":0,"rows":[\r\n{"id":"a","key":"x","value":{"s":"]}"}},\r\n{"id":"b","key":["y",1],"value":null},\r\n{"id":"c","key":"\\u00e9","value":2}\r\n]}\n'
+
+	def test_Rows(self):
+		for chunk_size in (1, 7, 65536):
+			rows = list(database._iter_view_rows(StringIO(self.BODY), chunk_size))
+			self.assertEquals(['a', 'b', 'c'], [row['id'] for row in rows])
+			self.assertEquals({"s": "]}"}, rows[0]['value'])
+			self.assertEquals(u"\u00e9", rows[2]['key'])
+
+	def test_Empty(self):
+		self.assertEquals([], list(database._iter_view_rows(StringIO('{"total_rows":0,"offset":0,"rows":[]}'), 5)))
+
+	def test_Truncated(self):
+		with self.assertRaises(database.DatabaseError):
+			list(database._iter_view_rows(StringIO(self.BODY[:60]), 7))
+
+class FakeResponse(object):
+	def __init__(self, body, chunked):
+		self.fp = StringIO(body)
+		self.chunked = chunked
+
+class TestResponseLines(unittest.TestCase):
+	def test_Chunked(self):
+		body = '9\r\n{"a": 1}\n\r\n1\r\n\n\r\nA\r\n{"b": 2}\r\n\r\n0\r\n\r\n'
+		self.assertEquals(['{"a": 1}', '', '{"b": 2}'], list(database._iter_response_lines(FakeResponse(body, True))))
+
+	def test_NotChunked(self):
+		self.assertEquals(['{"a": 1}', '', '{"b": 2}'], list(database._iter_response_lines(FakeResponse('{"a": 1}\n\n{"b": 2}\r\n', False))))
+
+class FakeCompressedResponse(object):
+	def __init__(self, body, encoding):
+		self.fp = StringIO(body)
+		self.encoding = encoding
+
+	def getheader(self, name, default = None):
+		return self.encoding if name == 'Content-Encoding' else default
+
+	def read(self, size = -1):
+		return self.fp.read(size)
+
+class TestCompression(unittest.TestCase):
+	BODY = '{"total_rows":2,"offset":0,"rows":[\r\n{"id":"a","key":"x","value":1},\r\n{"id":"b","key":"y","value":2}\r\n]}\n'
+
+	def test_ReadBody(self):
+		self.assertEquals(self.BODY, database._read_body(FakeCompressedResponse(database._gzip(self.BODY), 'gzip')))
+		self.assertEquals(self.BODY, database._read_body(FakeCompressedResponse(zlib.compress(self.BODY), 'deflate')))
+		self.assertEquals(self.BODY, database._read_body(FakeCompressedResponse(self.BODY, None)))
+
+	def test_StreamRows(self):
+		res = FakeCompressedResponse(database._gzip(self.BODY), 'gzip')
+		rows = list(database._iter_view_rows(database._DecompressingReader(res, database._decompressor(res)), 7))
+		self.assertEquals(['a', 'b'], [row['id'] for row in rows])
+
+	def test_EncodeBody(self):
+		db = database.CouchDB.__new__(database.CouchDB)
+		db.compression = True
+		db.compress_min_size = 100
+		headers = {'Content-type': 'application/json'}
+		self.assertEquals('{}', db._encode_body('{}', headers))
+		self.assertNotIn('Content-Encoding', headers)
+		body = db._encode_body(self.BODY, headers)
+		self.assertEquals('gzip', headers['Content-Encoding'])
+		self.assertEquals(self.BODY, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+		headers = {'Content-type': 'image/png'}
+		self.assertEquals(self.BODY, db._encode_body(self.BODY, headers))
+
+class FakeStreamDatabase(object):
+	def __init__(self, rows):
+		self.rows = rows
+		self.requests = []
+		self.finished = 0
+
+	def _stream_rows(self, method, url, query, body, headers, model = None):
+		self.requests.append(dict(query))
+		start = [row['id'] for row in self.rows].index(query['startkey_docid']) if 'startkey_docid' in query else 0
+		for row in self.rows[start:start + query['limit']]:
+			yield row
+		self.finished += 1
+
+class TestStreamByKey(unittest.TestCase):
+	def test_ResponsesReadToTheEnd(self):
+		db = FakeStreamDatabase([{'key': i, 'id': str(i), 'value': None} for i in range(0, 5)])
+		res = database.CouchDBViewResult(db, SampleModel, 'getByStrField')
+		self.assertEquals(['0', '1', '2', '3', '4'], [row['id'] for row in res._iter_rows_by_key(2)])
+		self.assertEquals(3, len(db.requests))
+		self.assertEquals(3, db.finished)
+
+class TestMangoSupport(unittest.TestCase):
+	def test_Version(self):
+		db = database.CouchDB.__new__(database.CouchDB)
+		db.server_version = '1.2.0'
+		self.assertFalse(db.has_mango())
+		with self.assertRaises(errors.DatabaseError):
+			db.sync_indexes()
+		with self.assertRaises(errors.DatabaseError):
+			db.find(SampleModel, {'strField': "Test"})
+		db.server_version = '2.3.1'
+		self.assertTrue(db.has_mango())
+
+class DroppingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Answers the server check, and drops the connection without answering anything else"""
+	def _handle(self):
+		self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		if self.path == '/?':
+			body = '{"couchdb": "Welcome"}'
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		else:
+			self.server.dropped.append(self.command)
+			self.close_connection = 1
+
+	do_GET = do_POST = _handle
+
+	def log_message(self, *args):
+		pass
+
+class DroppingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class TestRetries(unittest.TestCase):
+	def setUp(self):
+		self.server = DroppingServer(('127.0.0.1', 0), DroppingHandler)
+		self.server.dropped = []
+		threading.Thread(target = self.server.serve_forever).start()
+		self._instances = database.Database.instances
+		database.Database.instances = {}
+		self.db = database.CouchDB('http://127.0.0.1:%d' % (self.server.server_address[1],), 'lingo-test', sync_views = False)
+
+	def tearDown(self):
+		database.Database.instances = self._instances
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_RetryIdempotent(self):
+		with self.assertRaises(errors.DatabaseError):
+			self.db._request_db('GET', '/abc')
+		self.assertEquals(['GET'] * 3, self.server.dropped)
+
+	def test_NoRetryAfterSent(self):
+		with self.assertRaises(errors.DatabaseError):
+			self.db._bulk_request(None, [{'_id': 'abc'}])
+		self.assertEquals(['POST'], self.server.dropped)
+
+	def test_RetryReadOnlyPost(self):
+		with self.assertRaises(errors.DatabaseError):
+			self.db.get_many(None, ['a', 'b'])
+		self.assertEquals(['POST'] * 3, self.server.dropped)
+
 if __name__=="__main__":
 	unittest.main()
\ No newline at end of file
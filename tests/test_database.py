@@ -0,0 +1,154 @@
+import unittest, bson
+from lingo import lingo, database
+
+class SampleEmbeddedModel(lingo.Model):
+	class __Prototype__:
+		__Embedded__=True
+		strField=lingo.Field(unicode, default=u"")
+		intField=lingo.Field(int, default=0)
+
+class SampleModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(bson.ObjectId)
+		strField=lingo.Field(unicode, default=u"")
+		embedField=lingo.Field(SampleEmbeddedModel, default=SampleEmbeddedModel)
+
+SampleModel.__Prototype__.linkField=lingo.Field(SampleModel, default=None)
+SampleModel._invalidate_schema()
+
+class SampleRefModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+		strField=lingo.Field(unicode, default=u"")
+
+SampleRefModel.__Prototype__.linkField=lingo.Field(SampleRefModel, default=None)
+SampleRefModel._invalidate_schema()
+
+class SampleDictDatabase(database.Database):
+	def __init__(self, docs):
+		super(SampleDictDatabase, self).__init__()
+		self.docs = docs
+		self.queries = []
+
+	def get(self, model, _id):
+		self.queries.append([_id])
+		return model._load(self.docs[_id])
+
+	def _get_by_ids(self, model, ids):
+		self.queries.append(sorted(ids))
+		return {_id: model._load(self.docs[_id]) for _id in ids if _id in self.docs}
+
+class TestDatabase(unittest.TestCase):
+	def setUp(self):
+		self._instances = database.Database.instances
+		database.Database.instances = {}
+
+	def tearDown(self):
+		database.Database.instances = self._instances
+
+	def _refDatabase(self):
+		docs = {
+			u'a': dict(_id=u'a', strField=u'A', linkField=u'c'),
+			u'b': dict(_id=u'b', strField=u'B', linkField=u'c'),
+			u'c': dict(_id=u'c', strField=u'C'),
+			u'd': dict(_id=u'd', strField=u'D', linkField=u'missing'),
+		}
+		SampleRefModel._database = SampleDictDatabase(docs)
+		self.addCleanup(delattr, SampleRefModel, '_database')
+		return SampleRefModel._database
+
+	def test_ReferenceLoadedOnRead(self):
+		db = self._refDatabase()
+		i = SampleRefModel._load(db.docs[u'a'])
+		self.assertEquals(u'c', i._unresolved_reference('linkField'))
+		self.assertEquals(u'C', i.linkField.strField)
+		self.assertEquals([[u'c']], db.queries)
+		self.assertIs(i.linkField, i.linkField)
+		self.assertFalse(i.is_dirty())
+		self.assertEquals(u'c', i._to_json()['linkField'])
+
+	def test_ReferencePrefetch(self):
+		db = self._refDatabase()
+		instances = [SampleRefModel._load(db.docs[k]) for k in sorted(db.docs)]
+		db._prefetch(instances, ['linkField'])
+		self.assertEquals([[u'c', u'missing']], db.queries)
+		self.assertIs(instances[0].linkField, instances[1].linkField)
+		self.assertIsNone(instances[2].linkField)
+		self.assertEquals(u'missing', instances[3]._unresolved_reference('linkField'))
+		self.assertEquals(u'missing', instances[3]._to_json()['linkField'])
+		self.assertFalse(instances[3].is_dirty())
+
+	def test_ReferenceById(self):
+		self._refDatabase()
+		i = SampleRefModel(linkField=u'b')
+		self.assertEquals(u'b', i._to_json()['linkField'])
+		self.assertEquals(u'B', i.linkField.strField)
+		self.assertEquals(u'b', i._to_json()['linkField'])
+
+	def test_ReferencePrefetchInvalidField(self):
+		db = self._refDatabase()
+		with self.assertRaises(lingo.ModelError):
+			db._prefetch([SampleRefModel._load(db.docs[u'a'])], ['strField'])
+
+	def test_LRUCache(self):
+		c = database.LRUCache(2)
+		c.put('a', 1)
+		c.put('b', 2)
+		self.assertEquals(1, c.get('a'))
+		c.put('c', 3)
+		self.assertNotIn('b', c)
+		self.assertEquals(2, len(c))
+		self.assertEquals(1, c.pop('a'))
+		self.assertIsNone(c.get('a'))
+
+	def test_TimeOrderedId(self):
+		ids = [database.time_ordered_id() for _ in range(0, 100)]
+		self.assertEquals(32, len(ids[0]))
+		self.assertEquals(100, len(set(ids)))
+		first, last = ids[0], database.time_ordered_id()
+		self.assertLessEqual(first[:14], last[:14])
+
+	def test_UUIDPool(self):
+		class UUIDDatabase(object):
+			calls = 0
+			def _get_uuids(self, count = 1):
+				self.calls += 1
+				return ['%d-%d' % (self.calls, i) for i in range(0, count)]
+		db = UUIDDatabase()
+		pool = database.UUIDPool(db, 3)
+		self.assertEquals(['1-0', '1-1', '1-2', '2-0'], [pool() for _ in range(0, 4)])
+		self.assertEquals(2, db.calls)
+
+	def test_SessionIdentityMap(self):
+		db = self._refDatabase()
+		with db.session(maxsize=2) as session:
+			self.assertIs(session, db._get_session())
+			a = db._merge(SampleRefModel._load(db.docs[u'a']))
+			self.assertIs(a, db._merge(SampleRefModel._load(db.docs[u'a'])))
+			self.assertIs(a, session.get(SampleRefModel, u'a'))
+			db._merge(SampleRefModel._load(db.docs[u'b']))
+			db._merge(SampleRefModel._load(db.docs[u'c']))
+			self.assertIsNone(session.get(SampleRefModel, u'a'))
+			session.remove(session.get(SampleRefModel, u'b'))
+			self.assertEquals(1, len(session))
+		self.assertIsNone(db._get_session())
+
+	def test_SessionPrefetch(self):
+		db = self._refDatabase()
+		with db.session():
+			c = db._merge(SampleRefModel._load(db.docs[u'c']))
+			a = SampleRefModel._load(db.docs[u'a'])
+			db._prefetch([a], ['linkField'])
+			self.assertIs(c, a.linkField)
+			self.assertEquals([], db.queries)
+
+	def test_MongoProjectedFields(self):
+		self.assertIsNone(database.MongoDB._projected_fields(SampleModel, None))
+		self.assertEquals(set(['_id', 'strField']), database.MongoDB._projected_fields(SampleModel, ['strField']))
+		self.assertEquals(set(['strField']), database.MongoDB._projected_fields(SampleModel, {'strField': 1, '_id': 0}))
+		self.assertEquals(set(['_id', 'strField', 'linkField']), database.MongoDB._projected_fields(SampleModel, {'embedField': False}))
+		with self.assertRaises(lingo.ModelError):
+			database.MongoDB._projected_fields(SampleModel, ['embedField.intField'])
+
+if __name__=="__main__":
+	unittest.main()
@@ -15,11 +15,24 @@ class SampleModel(lingo.Model):
         embedField=lingo.Field(SampleEmbeddedModel, default=SampleEmbeddedModel)
 
 SampleModel.__Prototype__.linkField=lingo.Field(SampleModel, default=None)
+SampleModel._invalidate_schema()
 
 class SampleNestedModel(lingo.Model):
     class __Prototype__:
         nestedField = lingo.Field(dict, lingo.Field(list, SampleEmbeddedModel))
 
+class SampleStrictModel(lingo.Model):
+    class __Prototype__:
+        __Strict__=True
+        __Type__="Strict"
+        strField=lingo.Field(unicode, default=u"")
+        listField=lingo.Field(list, int, default=list)
+
+class SampleContainerModel(lingo.Model):
+    class __Prototype__:
+        anyField=lingo.Field(None)
+        itemsField=lingo.Field(list, dict)
+
 class TestFieldsModels(unittest.TestCase):
     def test_FieldValidation(self):
         f=lingo.Field(int, default=0)
@@ -158,3 +171,195 @@ class TestFieldsModels(unittest.TestCase):
         dt = datetime(2015, 1, 4, 5, 47, 45).replace(tzinfo = pytz.timezone("UTC"))
         self.assertEquals(dt, f._to_python('2015-01-04T05:47:45'))
         self.assertEquals('UTC', dt.tzname())
+
+    def test_SchemaFlags(self):
+        self.assertTrue(SampleStrictModel._schema.strict)
+        self.assertFalse(SampleStrictModel._schema.embedded)
+        self.assertTrue(SampleEmbeddedModel._schema.embedded)
+        self.assertEquals("Strict", SampleStrictModel.get_type_name())
+        self.assertEquals("SampleModel", SampleModel.get_type_name())
+        self.assertEquals(set(['_id', 'strField', 'embedField', 'linkField']), set(SampleModel._fields().keys()))
+
+    def test_SchemaStrict(self):
+        i=SampleStrictModel(strField="foo")
+        self.assertEquals(u"foo", i.strField)
+        with self.assertRaises(lingo.ValidationError):
+            i.notAField=1
+
+    def test_SchemaMutableDefaultsNotShared(self):
+        a=SampleStrictModel()
+        b=SampleStrictModel()
+        a.listField.append(1)
+        self.assertEquals([], b.listField)
+        self.assertIsNot(SampleModel().embedField, SampleModel().embedField)
+
+    def test_SchemaInvalidDefault(self):
+        class SampleBadDefaultModel(lingo.Model):
+            class __Prototype__:
+                intField = lingo.Field(int, default="abc")
+        with self.assertRaises(ValueError):
+            SampleBadDefaultModel()
+
+    def test_SchemaInvalidation(self):
+        SampleStrictModel.__Prototype__.intField=lingo.Field(int, default=3)
+        try:
+            self.assertNotIn('intField', SampleStrictModel._fields())
+            SampleStrictModel._invalidate_schema()
+            self.assertEquals(3, SampleStrictModel().intField)
+        finally:
+            del(SampleStrictModel.__Prototype__.intField)
+            SampleStrictModel._invalidate_schema()
+        self.assertNotIn('intField', SampleStrictModel._fields())
+
+    def test_ModelWithoutPrototype(self):
+        with self.assertRaises(lingo.ModelError):
+            lingo.Model()
+
+    def test_LoadIsLazy(self):
+        raw = dict(strField=u"foo", embedField=dict(strField=u"bar", intField=3), notAField=1)
+        i = SampleModel._load(raw)
+        self.assertEquals({}, i.__data__)
+        self.assertEquals(u"foo", i.strField)
+        self.assertEquals(['strField'], i.__data__.keys())
+        self.assertEquals(3, i.embedField.intField)
+        self.assertIsNone(i.linkField)
+
+    def test_LoadSerializesRaw(self):
+        embed = dict(strField=u"bar", intField=3)
+        i = SampleModel._load(dict(strField=u"foo", embedField=embed))
+        out = i._to_json()
+        self.assertIs(embed, out['embedField'])
+        self.assertEquals(u"foo", out['strField'])
+        self.assertIsNone(out['linkField'])
+        self.assertNotIn('notAField', out)
+        self.assertNotIn('embedField', i.__data__)
+
+    def test_LoadThenModify(self):
+        i = SampleModel._load(dict(strField=u"foo", embedField=dict(strField=u"bar", intField=3)))
+        i.embedField.intField = "12"
+        i.strField = "baz"
+        out = i._to_json()
+        self.assertEquals(12, out['embedField']['intField'])
+        self.assertEquals(u"baz", out['strField'])
+
+    def test_LoadShared(self):
+        class SampleUntypedModel(lingo.Model):
+            class __Prototype__:
+                anyField = lingo.Field(None)
+                listField = lingo.Field(list)
+        raw = dict(anyField=dict(a=[1, 2]), listField=[dict(b=1)])
+        i = SampleUntypedModel._load(raw, shared=True)
+        i.anyField['a'].append(3)
+        i.listField[0]['b'] = 2
+        self.assertEquals(dict(anyField=dict(a=[1, 2]), listField=[dict(b=1)]), raw)
+        self.assertEquals(set(['anyField', 'listField']), i.changed_fields())
+        i = SampleUntypedModel._load(raw, shared=True)
+        i._asdict()['anyField']['a'].append(3)
+        self.assertEquals(dict(anyField=dict(a=[1, 2]), listField=[dict(b=1)]), raw)
+
+    def test_ListFieldConversion(self):
+        f = lingo.Field(list, int)
+        self.assertEquals([1, 2], f.validate(["1", 2]))
+        self.assertEquals([3], f.validate("3"))
+        self.assertIsNone(f.validate(None))
+        value = [1, 2]
+        self.assertIsNot(value, f._to_json(value))
+        self.assertEquals(value, f._to_json(value))
+
+    def test_DictFieldConversion(self):
+        f = lingo.Field(dict, lingo.Field(list, int))
+        self.assertEquals({'a': [1], 'b': [2, 3]}, f.validate({'a': "1", 'b': ["2", 3]}))
+        self.assertEquals({'a': [1]}, f._to_json({'a': [1]}))
+
+    def test_DatetimeStringToPython_FastPathIsUTC(self):
+        f = lingo.Field(datetime)
+        out = f._to_python('2015-01-04T05:47:45.5+00:00')
+        self.assertEquals(datetime(2015, 1, 4, 5, 47, 45, 500000).replace(tzinfo = pytz.timezone("UTC")), out)
+        self.assertEquals('UTC', out.tzname())
+
+    def test_DatetimeStringToPython_Offset(self):
+        f = lingo.Field(datetime)
+        dt = datetime(2015, 1, 4, 3, 47, 45).replace(tzinfo = pytz.timezone("UTC"))
+        self.assertEquals(dt, f._to_python('2015-01-04T05:47:45+02:00'))
+        self.assertEquals(dt, f._to_python('January 4 2015 03:47:45'))
+
+    def test_DatetimeRoundTrip(self):
+        f = lingo.Field(datetime)
+        dt = datetime(2015, 1, 4, 5, 47, 45, 578293).replace(tzinfo = pytz.timezone("UTC"))
+        self.assertEquals(dt, f._to_python(f._to_json(dt)))
+
+    def test_EpochDatetimeField(self):
+        f = lingo.Field(datetime, epoch=True)
+        dt = datetime(2015, 1, 4, 5, 47, 45, 578293).replace(tzinfo = pytz.timezone("UTC"))
+        self.assertEquals(1420350465578293, f._to_json(dt))
+        self.assertEquals(1420350465578293, f._to_json(dt.replace(tzinfo = None)))
+        self.assertEquals(dt, f._to_python(1420350465578293))
+        self.assertEquals('UTC', f._to_python(1420350465578293).tzname())
+        self.assertEquals(dt, f._to_python('2015-01-04T05:47:45.578293+00:00'))
+
+    def test_EpochDatetimeListField(self):
+        f = lingo.Field(list, datetime, epoch=True)
+        self.assertEquals([0], f._to_json(f._to_python([0])))
+
+    def test_DirtyNewInstance(self):
+        i = SampleModel()
+        self.assertTrue(i.is_dirty())
+        self.assertEquals(set(SampleModel._fields()), i.changed_fields())
+
+    def test_DirtyLoadedInstance(self):
+        i = SampleModel._load(dict(strField=u"foo", embedField=dict(strField=u"bar", intField=3)))
+        self.assertFalse(i.is_dirty())
+        self.assertEquals(u"foo", i.strField)
+        self.assertFalse(i.is_dirty())
+        i.strField = u"foo"
+        self.assertFalse(i.is_dirty())
+        i.strField = u"baz"
+        self.assertEquals(set(['strField']), i.changed_fields())
+
+    def test_DirtyInPlaceModification(self):
+        i = SampleModel._load(dict(strField=u"foo", embedField=dict(strField=u"bar", intField=3)))
+        self.assertEquals(3, i.embedField.intField)
+        self.assertFalse(i.is_dirty())
+        i.embedField.intField = 4
+        self.assertEquals(set(['embedField']), i.changed_fields())
+
+    def test_DirtyInPlaceContainersAfterLoad(self):
+        raw = dict(anyField=[1], itemsField=[dict(qty=1)])
+        i = SampleContainerModel._load(raw)
+        i.itemsField[0]['qty'] = 2
+        self.assertEquals(set(['itemsField']), i.changed_fields())
+        i.anyField.append(2)
+        self.assertEquals(set(['anyField', 'itemsField']), i.changed_fields())
+        self.assertEquals(dict(anyField=[1], itemsField=[dict(qty=1)]), raw)
+
+    def test_DirtyInPlaceContainersAfterSave(self):
+        i = SampleContainerModel(anyField=[1], itemsField=[dict(qty=1)])
+        i._mark_clean(i._to_json())
+        self.assertFalse(i.is_dirty())
+        i.anyField.append(2)
+        i.itemsField[0]['qty'] = 2
+        self.assertEquals(set(['anyField', 'itemsField']), i.changed_fields())
+
+    def test_MarkClean(self):
+        i = SampleModel(strField=u"foo")
+        i._mark_clean(i._to_json())
+        self.assertFalse(i.is_dirty())
+        i.embedField.strField = u"bar"
+        self.assertEquals(set(['embedField']), i.changed_fields())
+
+    def test_PartialLoad(self):
+        i = SampleModel._load(dict(_id=bson.ObjectId(), strField=u"foo"), SampleModel._field_subset(only=['strField']))
+        self.assertTrue(i.is_partial())
+        self.assertEquals(set(['_id', 'strField']), i.loaded_fields())
+        self.assertEquals(u"foo", i.strField)
+        with self.assertRaises(lingo.ModelError):
+            i.embedField
+        self.assertEquals(set(['_id', 'strField']), set(i._to_json().keys()))
+        i.embedField = dict(intField=3)
+        self.assertEquals(set(['embedField']), i.changed_fields())
+        self.assertIn('embedField', i._to_json())
+
+    def test_FieldSubset(self):
+        self.assertEquals(set(['strField', 'embedField']), SampleModel._field_subset(exclude=['_id', 'linkField']))
+        with self.assertRaises(lingo.ModelError):
+            SampleModel._field_subset(only=['notAField'])
@@ -0,0 +1,62 @@
+import unittest
+from lingo import lingo, database, instrumentation
+
+class SampleModel(lingo.Model):
+	class __Prototype__:
+		_id=lingo.Field(unicode)
+
+class SampleDatabase(database.Database):
+	pass
+
+class TestInstrumentation(unittest.TestCase):
+	def setUp(self):
+		database.Database.instances = {}
+		self.db = SampleDatabase()
+
+	def test_Hooks(self):
+		events = []
+		self.db.add_hook(events.append)
+		self.db._record('GET', '/{db}/{id}', SampleModel, 0.5, 1)
+		self.assertEquals([instrumentation.Operation('SampleDatabase', 'GET', '/{db}/{id}', 'SampleModel', 0.5, 1, None)], events)
+		self.db.remove_hook(events.append)
+		self.db._record('GET', '/{db}/{id}', None, 0.5)
+		self.assertEquals(1, len(events))
+
+	def test_FailingHook(self):
+		def hook(event):
+			raise ValueError("broken")
+		self.db.add_hook(hook)
+		self.db._record('GET', '/', None, 0.1)
+
+	def test_Stats(self):
+		stats = self.db.add_hook(instrumentation.Stats(buckets = [0.01, 0.1]))
+		self.db._record('GET', '/{db}/{id}', SampleModel, 0.005)
+		self.db._record('GET', '/{db}/{id}', SampleModel, 0.05, 2)
+		self.db._record('GET', '/{db}/{id}', SampleModel, 0.5, 0, database.DatabaseError("500 Internal Server Error"))
+		self.db._record('decode', '/{db}/{id}', SampleModel, 0.001)
+		snapshot = stats.snapshot()
+		self.assertEquals(2, len(snapshot))
+		s = snapshot[('SampleDatabase', 'GET', '/{db}/{id}', 'SampleModel')]
+		self.assertEquals(3, s['count'])
+		self.assertEquals(1, s['errors'])
+		self.assertEquals(2, s['retries'])
+		self.assertAlmostEquals(0.185, s['mean'])
+		self.assertEquals(0.5, s['max'])
+		self.assertEquals([('0.01', 1), ('0.1', 1), ('+Inf', 1)], s['histogram'])
+		self.assertIn('SampleModel', stats.report())
+		stats.reset()
+		self.assertEquals({}, stats.snapshot())
+
+	def test_CouchDBURLTemplate(self):
+		db = database.CouchDB.__new__(database.CouchDB)
+		db.dbname = 'lingo-test'
+		self.assertEquals('/', db._url_template('/'))
+		self.assertEquals('/_uuids', db._url_template('/_uuids'))
+		self.assertEquals('/{db}', db._url_template('/lingo-test'))
+		self.assertEquals('/{db}/{id}', db._url_template('/lingo-test/abc123'))
+		self.assertEquals('/{db}/{id}/{name}', db._url_template('/lingo-test/abc123/test.txt'))
+		self.assertEquals('/{db}/_design/SampleModel/_view/getByStrField', db._url_template('/lingo-test/_design/SampleModel/_view/getByStrField'))
+		self.assertEquals('/{db}/_all_docs', db._url_template('/lingo-test/_all_docs?include_docs=true'))
+
+if __name__=="__main__":
+	unittest.main()
@@ -23,6 +23,7 @@ class TouchableModel(lingo.Model):
 		return True
 
 SampleModel.__Prototype__.linkField=lingo.Field(SampleModel, default=None)
+SampleModel._invalidate_schema()
 
 class TestMongoDB(unittest.TestCase):
 	def setUp(self):
@@ -37,8 +38,10 @@ class TestMongoDB(unittest.TestCase):
 
 	def test_getExplicitCollection(self):
 		SampleModel.__Prototype__.__Collection__="foobar"
+		SampleModel._invalidate_schema()
 		self.assertEquals(self.mdb._getCollection(SampleModel), self.db["foobar"])
 		del(SampleModel.__Prototype__.__Collection__)
+		SampleModel._invalidate_schema()
 
 	def test_CannotSaveEmbeddedModels(self):
 		i=SampleEmbeddedModel()
@@ -127,5 +130,88 @@ class TestMongoDB(unittest.TestCase):
 		self.mdb.save(i)
 		self.assertEquals(tempid, str(i._id))
 
+	def test_SaveOnlyChangedFields(self):
+		i=SampleModel(strField="foobar")
+		self.mdb.save(i)
+		self.db.SampleModel.update({"_id": i._id}, {"$set": {"embedField.intField": 5}})
+		i=self.mdb.get(SampleModel, i._id)
+		i.strField=u"barbaz"
+		self.assertEquals(set(['strField']), i.changed_fields())
+		self.mdb.save(i)
+		self.assertFalse(i.is_dirty())
+		doc=self.db.SampleModel.find_one({"_id": i._id})
+		self.assertEquals(u"barbaz", doc['strField'])
+		self.assertEquals(5, doc['embedField']['intField'])
+
+	def test_SaveClean(self):
+		i=TouchableModel()
+		self.mdb.save(i)
+		i=self.mdb.get(TouchableModel, i._id)
+		i.strField=u"untouched"
+		self.db.TouchableModel.update({"_id": i._id}, {"$set": {"strField": u"untouched"}})
+		i._mark_clean({"strField": u"untouched"})
+		self.mdb.save(i)
+		self.assertEquals(u"untouched", i.strField)
+
+	def test_GetReference(self):
+		SampleModel._database=self.mdb
+		self.addCleanup(delattr, SampleModel, '_database')
+		target=SampleModel(strField="target")
+		self.mdb.save(target)
+		i=SampleModel(strField="source", linkField=target)
+		self.mdb.save(i)
+		i=self.mdb.get(SampleModel, i._id)
+		self.assertEquals(u"target", i.linkField.strField)
+
+	def test_FindPrefetch(self):
+		SampleModel._database=self.mdb
+		self.addCleanup(delattr, SampleModel, '_database')
+		target=SampleModel(strField="target")
+		self.mdb.save(target)
+		for v in ["foo", "foo"]:
+			self.mdb.save(SampleModel(strField=v, linkField=target))
+
+		res = list(self.mdb.find(SampleModel, {"strField": "foo"}).prefetch('linkField'))
+		self.assertEquals(2, len(res))
+		self.assertIs(res[0].linkField, res[1].linkField)
+		self.assertEquals(u"target", res[0].linkField.strField)
+
+	def test_FindOnlySavesChangedFields(self):
+		i=SampleModel(strField="foobar")
+		i.embedField.intField=5
+		self.mdb.save(i)
+		p=self.mdb.find(SampleModel, {"_id": i._id}).only('strField')[0]
+		self.assertTrue(p.is_partial())
+		self.assertEquals(u"foobar", p.strField)
+		with self.assertRaises(lingo.ModelError):
+			p.embedField
+		p.strField=u"barbaz"
+		self.mdb.save(p)
+		doc=self.db.SampleModel.find_one({"_id": i._id})
+		self.assertEquals(u"barbaz", doc['strField'])
+		self.assertEquals(5, doc['embedField']['intField'])
+
+	def test_Count(self):
+		for i in range(0, 3):
+			self.mdb.save(SampleModel(strField="foobar"))
+		self.mdb.save(SampleModel(strField="other"))
+		self.assertEquals(3, self.mdb.find(SampleModel, {"strField": "foobar"}).count())
+		self.assertEquals(4, self.mdb.find(SampleModel, {}).count())
+		self.assertEquals(2, self.mdb.find(SampleModel, {}).limit(2).count(True))
+		self.assertEquals(1, self.mdb.find(SampleModel, {}).skip(3).count(True))
+		self.assertEquals(4, self.mdb.find(SampleModel, {}).skip(3).count())
+
+	def test_OneWithMany(self):
+		for i in range(0, 3):
+			self.mdb.save(SampleModel(strField="foobar"))
+		with self.assertRaises(lingo.ValidationError):
+			self.mdb.one(SampleModel, {"strField": "foobar"})
+
+	def test_FindWithFieldsIsPartial(self):
+		i=SampleModel(strField="foobar")
+		self.mdb.save(i)
+		p=self.mdb.find(SampleModel, {"_id": i._id}, fields={'embedField': False})[0]
+		self.assertEquals(set(['_id', 'strField', 'linkField']), p.loaded_fields())
+
 if __name__=="__main__":
-	unittest.main()
\ No newline at end of file
+	unittest.main()
@@ -0,0 +1,90 @@
+import time
+import socket
+import threading
+import unittest
+from lingo import pool, errors
+
+class TestConnectionPool(unittest.TestCase):
+	def setUp(self):
+		# Connections are only opened, never used for requests, so a bare listening socket will do
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(16)
+		self.port = self.server.getsockname()[1]
+
+	def tearDown(self):
+		self.server.close()
+
+	def test_Reuse(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 2)
+		conn = p.get()
+		p.put(conn)
+		self.assertIs(conn, p.get())
+		stats = p.stats()
+		self.assertEquals(1, stats['created'])
+		self.assertEquals(1, stats['reused'])
+		self.assertEquals(1, stats['in_use'])
+		self.assertEquals(0, stats['idle'])
+
+	def test_FailFast(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 1, block = False)
+		p.get()
+		with self.assertRaises(errors.PoolExhaustedError):
+			p.get()
+		self.assertEquals(1, p.stats()['exhausted'])
+
+	def test_Timeout(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 1, timeout = 0.05)
+		p.get()
+		started = time.time()
+		with self.assertRaises(errors.PoolExhaustedError):
+			p.get()
+		self.assertTrue(time.time() - started >= 0.05)
+
+	def test_BlockingHandOff(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 1)
+		conn = p.get()
+		got = []
+		t = threading.Thread(target = lambda: got.append(p.get()))
+		t.start()
+		time.sleep(0.05)
+		self.assertEquals([], got)
+		p.put(conn)
+		t.join(1)
+		self.assertEquals([conn], got)
+		self.assertEquals(1, p.stats()['waited'])
+
+	def test_Discard(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 1, block = False)
+		conn = p.get()
+		p.put(conn, discard = True)
+		self.assertIsNot(conn, p.get())
+		self.assertEquals(1, p.stats()['size'])
+
+	def test_IdleTimeout(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, idle_timeout = 0.01)
+		conn = p.get()
+		p.put(conn)
+		time.sleep(0.02)
+		self.assertIsNot(conn, p.get())
+		self.assertEquals(1, p.stats()['expired'])
+
+	def test_Dropped(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port)
+		conn = p.get()
+		p.put(conn)
+		accepted, _ = self.server.accept()
+		accepted.close()
+		time.sleep(0.02)
+		self.assertIsNot(conn, p.get())
+		self.assertEquals(1, p.stats()['dropped'])
+
+	def test_WarmAndClear(self):
+		p = pool.ConnectionPool('127.0.0.1', self.port, maxsize = 3)
+		self.assertEquals(3, p.warm(5))
+		self.assertEquals(3, p.stats()['idle'])
+		p.clear()
+		self.assertEquals(0, p.stats()['size'])
+
+if __name__=="__main__":
+	unittest.main()